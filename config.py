@@ -8,18 +8,61 @@ PROMETHEUS_PUSHGATEWAY_INSTANCE = "stats_collector"
 PROMETHEUS_PUSHGATEWAY_URL = "http://localhost:9091"
 
 SOLR_URL = 'http://localhost:9983/solr/collection1/'
+# Collect stats from every core/replica listed here (name: url) instead of only SOLR_URL, the
+# metrics are labeled with the core name
+SOLR_CORES = {}
+# Stats requests sent concurrently (3 per core)
+SOLR_STATS_WORKERS = 6
+# Export bibcodes concurrently, one cursor walk per range between these bibcode prefixes
+# (e.g. ("1990", "2000", "2010")), or in a single walk if empty
+SOLR_BIBCODES_SHARDS = ()
+SOLR_BIBCODES_WORKERS = 4
+# Pages each shard walk fetches ahead of the consumer (bounds the memory to about
+# SOLR_BIBCODES_WORKERS * (SOLR_BIBCODES_PREFETCH + 1) pages)
+SOLR_BIBCODES_PREFETCH = 2
+# Page size and timeout (seconds) of every request, sharded or not
+SOLR_BIBCODES_ROWS = 20000
+SOLR_BIBCODES_TIMEOUT = 120
+# 'json' (cursorMark) or 'csv' (compact responses, paging on the last bibcode), sharded or not
+SOLR_BIBCODES_FORMAT = 'json'
 
 POSTGRES_HOST = "localhost"
 POSTGRES_PORT = 5432
 POSTGRES_USER = "user"
 POSTGRES_PASSWORD = "<secret>"
 POSTGRES_MASTER_PIPELINE_DB = "master_pipeline"
+POSTGRES_BIBCODES_FETCH_SIZE = 100000
+# Connections shared by all the collectors/scripts of a process (statscollector/pgpool.py)
+POSTGRES_POOL_MAX_CONNECTIONS = 8
+# Seconds after which the server cancels a statement (None: no limit), pgpool.connection() can
+# override it per call
+POSTGRES_STATEMENT_TIMEOUT = None
+# Read-only queries go to this host (and port) when set, instead of POSTGRES_HOST
+POSTGRES_REPLICA_HOST = None
+POSTGRES_REPLICA_PORT = 5432
 
 # http://localhost:9000/system/authentication/users/tokens/admin
 GRAYLOG_TOKEN = '<secret>'
 GRAYLOG_URL = "http://localhost:9000/"
+# Number of searches sent concurrently through a pooled session (1 sends them one by one with grapi)
+GRAYLOG_WORKERS = 1
+# Seconds before a search is abandoned
+GRAYLOG_TIMEOUT = 30
 GRAYLOG_MYADS_QUERY = 'namespace_name:back-prod AND container_name:myads_pipeline AND message:"Email sent to *"'
 GRAYLOG_CONTAINER_QUERY = 'namespace_name:back-prod AND container_name:{}'
+# Count all the containers with a single terms aggregation (legacy search API) instead of one
+# search per container, which is kept as fallback
+GRAYLOG_AGGREGATE_CONTAINERS = False
+GRAYLOG_CONTAINERS_TERMS_QUERY = 'namespace_name:back-prod AND container_name:({})'
+# Assemble the hourly counts from cached one-minute buckets (legacy histogram API), only asking
+# Graylog for the buckets completed since the previous run
+GRAYLOG_BUCKETED = False
+GRAYLOG_BUCKET_MINUTES = 1
+# Minutes to wait before considering a bucket complete (indexing delay)
+GRAYLOG_BUCKET_DELAY = 1
+# Minutes cached buckets are kept once out of the hourly window
+GRAYLOG_BUCKET_TTL = 60
+GRAYLOG_BUCKET_CACHE_FILE = "graylog_buckets.json"
 GRAYLOG_CONTAINER_NAMES = (
     "fulltext_pipeline",
     "citation_capture_pipeline",
@@ -38,6 +81,18 @@ GRAYLOG_CONTAINER_NAMES = (
 )
 
 CLASSIC_CANONICAL_FILE = "/bibcodes.list.can"
+# Compare classic/postgres/solr with a streaming merge of sorted bibcodes instead of in-memory sets
+CLASSIC_STREAMING = False
+# Hold the bibcodes in compact sorted arrays (numpy) instead of python sets
+CLASSIC_COMPACT_SETS = False
+# Keep snapshots of the discrepancies to report new/resolved ones, and of postgres, which is
+# extended with the records updated since the previous run and fully refreshed every
+# CLASSIC_SNAPSHOT_DB_REFRESH_INTERVAL hours
+CLASSIC_SNAPSHOTS = False
+CLASSIC_SNAPSHOT_DIR = "classic_snapshots"
+CLASSIC_SNAPSHOT_DB_REFRESH_INTERVAL = 168
+# Sidecar index with the layout and sortedness of the canonical file (rebuilt when the file changes)
+CLASSIC_CANONICAL_INDEX_FILE = "classic_canonical_index.npz"
 
 GOOGLE_DRIVE_KEEP_LAST_N_FOLDERS = 7
 # Please, follow the instructions in https://developers.google.com/drive/api/v3/quickstart/python to download the file 'credentials.json'
@@ -45,8 +100,72 @@ GOOGLE_DRIVE_CREDENTIALS_FILENAME = "credentials.json"
 GOOGLE_DRIVE_TOKEN_FILENAME = "token.json"
 # https://drive.google.com/drive/u/1/folders/ID
 GOOGLE_DRIVE_FOLDER_ID = "ID"
+# Discovery document the Drive client is built from (fetched once per process)
+GOOGLE_DRIVE_DISCOVERY_URL = "https://www.googleapis.com/discovery/v1/apis/{api}/{apiVersion}/rest"
+GOOGLE_DRIVE_TIMEOUT = 60
+# Discrepancy files uploaded concurrently
+GOOGLE_DRIVE_UPLOAD_WORKERS = 4
+# Stream the discrepancy files straight from the comparison results with resumable uploads
+# (chunk size must be a multiple of 256 KB), instead of writing temporary files first
+GOOGLE_DRIVE_STREAMING_UPLOAD = False
+GOOGLE_DRIVE_UPLOAD_CHUNK_SIZE = 5 * 1024 * 1024
+# Upload the streamed files gzip-compressed (.txt.gz)
+GOOGLE_DRIVE_GZIP = False
+# Track the day folders in a local manifest and delete the expired ones with batch requests,
+# the parent folder being listed again only every GOOGLE_DRIVE_MANIFEST_RELIST_DAYS
+GOOGLE_DRIVE_BATCH_CLEANUP = False
+GOOGLE_DRIVE_MANIFEST_FILE = "google_drive_folders.json"
+GOOGLE_DRIVE_MANIFEST_RELIST_DAYS = 30
 
 SOURCES_DIR = "/sources"
 PDF_SOURCES_DIR = "/seri"
 STDDEV_CUTOFF = 1.5
 COUNT_ERR = 5
+# Check all the bibstems of a year with a single query in scripts/fulltext.py (--set-based)
+FULLTEXT_SET_BASED = False
+# Bibstems checked concurrently by scripts/fulltext.py (--workers), keep it under POSTGRES_POOL_MAX_CONNECTIONS
+FULLTEXT_WORKERS = 1
+# Read the fulltext lengths from an incrementally refreshed summary table (--summary), it is
+# created in the master pipeline database and refreshed on the primary
+FULLTEXT_SUMMARY = False
+FULLTEXT_SUMMARY_TABLE = "fulltext_summary"
+# Minutes re-read before the latest summarized fulltext_updated on every refresh, to pick up the
+# records committed late by long transactions (keep it above the longest fulltext write)
+FULLTEXT_SUMMARY_REFRESH_MARGIN = 60
+
+# Scheduler used by 'run.py --parallel'
+COLLECTOR_MAX_WORKERS = 4
+COLLECTOR_TIMEOUT = 3600
+# Seconds between two runs of each collector in daemon mode (run.py --daemon)
+COLLECTOR_INTERVALS = {
+    'graylog': 60,
+    'solr': 60,
+    'postgres': 15 * 60,
+    'classic': 24 * 60 * 60,
+}
+
+# Push all the metrics of a collector in a single request (grouped under job=<collector>)
+PROMETHEUS_PUSHGATEWAY_BATCH = False
+PROMETHEUS_PUSHGATEWAY_POOL_SIZE = 4
+# Serve the collected values at http://<host>:<port>/metrics instead of pushing them (run.py --exporter-port)
+PROMETHEUS_EXPORTER_PORT = None
+# Push the wall time, sub-query timings, requests and success of every collector run as the
+# stats_collector metrics (labeled with the collector name), along with the peak RSS of the whole
+# process so far (process_peak_rss_bytes, shared by the collectors running in the same process).
+# There is one sample per sub-query figure so PROMETHEUS_PUSHGATEWAY_BATCH is recommended
+COLLECTOR_INSTRUMENTATION = False
+
+# Compute postgres.stats() in a single scan of records (STATS) instead of one query per figure
+# (CREATED, UPDATED, PROCESSED and COUNTS). The single scan touches fewer buffers but cannot use
+# the timestamp indexes: on 100k synthetic rows (scripts/postgres_benchmark.py) it takes 79 ms
+# against 34 ms for the per-figure queries when every timestamp column is indexed (as in
+# production), and 66 ms against 260 ms when none is. Only enable it without those indexes.
+POSTGRES_SINGLE_SCAN_STATS = False
+
+# Advance the registered counts from a local checkpoint instead of counting all the records every run
+POSTGRES_INCREMENTAL_REGISTERED = False
+POSTGRES_CHECKPOINT_FILE = "postgres_checkpoint.json"
+# Hours between full recounts of the registered counts. In between, the counts are only advanced
+# with the records created since the last run: columns set later on older records, cleared columns
+# and deletions show up at the recount
+POSTGRES_REGISTERED_RECOUNT_INTERVAL = 24
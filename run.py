@@ -1,5 +1,7 @@
 import os
 import sys
+import signal
+import threading
 import requests
 import argparse
 from adsputils import setup_logging, load_config
@@ -9,9 +11,88 @@ from statscollector import prometheus
 from statscollector import graylog
 from statscollector import classic
 from statscollector import googledrive
+from statscollector import scheduler
+from statscollector import instrumentation
 from statscollector.setup import config, logger
 
 
+# Every collector returns whether all its figures were collected, the sub-queries that fail are
+# logged and skipped
+
+def collect_graylog(args):
+    # ~1 second
+    logs_stats = graylog.stats()
+    prometheus.push("logs", logs_stats, simulate=args.no_push)
+    expected = ['myads_pipeline_emails'] + list(config.get('GRAYLOG_CONTAINER_NAMES', []))
+    return all(logs_stats.get(key) is not None for key in expected)
+
+def collect_solr(args):
+    # ~1 second
+    if config.get('SOLR_CORES', {}):
+        # One push per core/replica, labeled with the core name
+        cores_stats = solr.cores_stats()
+        for core, core_stats in cores_stats.items():
+            prometheus.push("solr", core_stats, label=core, simulate=args.no_push)
+    else:
+        cores_stats = {'default': solr.stats()}
+        prometheus.push("solr", cores_stats['default'], simulate=args.no_push)
+    # The stats queries fill different keys, their failures are only known from the instrumentation
+    return all(cores_stats.values()) and instrumentation.errors('solr') == 0
+
+def collect_postgres(args):
+    # ~5 minutes
+    db_stats = postgres.stats()
+    prometheus.push("master_pipeline_records", db_stats, simulate=args.no_push)
+    return bool(db_stats)
+
+def collect_classic(args):
+    # ~15 minutes
+    if config.get('CLASSIC_STREAMING', False):
+        # Merge the three sorted streams, only discrepancies are kept in memory
+        bibcodes_stats, bibcodes_batch = classic.compare_sorted(classic.sorted_bibcodes(), postgres.sorted_bibcodes(), solr.sorted_bibcodes())
+    elif config.get('CLASSIC_SNAPSHOTS', False):
+        # Also reports the discrepancies that are new or resolved since the previous run
+        bibcodes_stats, bibcodes_batch = classic.compare_snapshot(config.get('CLASSIC_SNAPSHOT_DIR', 'classic_snapshots'))
+    elif config.get('CLASSIC_COMPACT_SETS', False):
+        # Compact sets filled from the mapped canonical file and the postgres/solr streams, without intermediate lists
+        bibcodes_stats, bibcodes_batch = classic.compare(classic.bibcodeset(), postgres.bibcodes(), solr.sorted_bibcodes())
+    else:
+        classic_bibcodes = classic.bibcodes()
+        db_bibcodes = postgres.bibcodes()
+        solr_bibcodes = solr.bibcodes()
+        bibcodes_stats, bibcodes_batch = classic.compare(classic_bibcodes, db_bibcodes, solr_bibcodes)
+    prometheus.push("classic", bibcodes_stats, simulate=args.no_push)
+    if not args.no_classic_upload:
+        googledrive.upload(bibcodes_batch, keep_last_n_folders=config.get('GOOGLE_DRIVE_KEEP_LAST_N_FOLDERS', 30))
+    # Sources that could not be retrieved are left out of the comparison
+    return all(name in bibcodes_stats for name in classic.DISCREPANCIES)
+
+COLLECTORS = (
+    ('graylog', collect_graylog),
+    ('solr', collect_solr),
+    ('postgres', collect_postgres),
+    ('classic', collect_classic),
+)
+
+def run_collector(name, collector, args):
+    """
+    Run a collector, with COLLECTOR_INSTRUMENTATION its own timing, sub-queries, requests and
+    success (plus the process peak RSS) are pushed afterwards as the stats_collector metrics
+    labeled with its name. The run fails if the collector raises or does not collect everything.
+    """
+    if not config.get('COLLECTOR_INSTRUMENTATION', False):
+        return collector(args)
+    run_stats = None
+    try:
+        with instrumentation.collector_run() as run_stats:
+            collected = collector(args)
+            run_stats['success'] = int(bool(collected))
+            return collected
+    finally:
+        if run_stats is not None:
+            logger.info("Collector '%s' %s in %.1f seconds", name, "finished" if run_stats['success'] else "failed", run_stats['seconds'])
+            prometheus.push("stats_collector", run_stats, label=name, simulate=args.no_push)
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Collect statistics')
@@ -51,34 +132,58 @@ if __name__ == '__main__':
                         default=False,
                         action='store_true',
                         help='Do not upload files with missing/extra bibcodes to Google Team Drive')
+    parser.add_argument('--parallel',
+                        dest='parallel',
+                        default=False,
+                        action='store_true',
+                        help='Run the selected collectors concurrently instead of one after another')
+    parser.add_argument('--max-workers',
+                        dest='max_workers',
+                        default=config.get('COLLECTOR_MAX_WORKERS', None),
+                        type=int,
+                        help='Maximum number of collectors running at the same time (with --parallel)')
+    parser.add_argument('--timeout',
+                        dest='timeout',
+                        default=config.get('COLLECTOR_TIMEOUT', None),
+                        type=float,
+                        help='Seconds after which a running collector is abandoned (with --parallel or --daemon)')
+    parser.add_argument('--daemon',
+                        dest='daemon',
+                        default=False,
+                        action='store_true',
+                        help='Keep running the selected collectors (all of them if none is selected) at the intervals in COLLECTOR_INTERVALS')
+    parser.add_argument('--exporter-port',
+                        dest='exporter_port',
+                        default=config.get('PROMETHEUS_EXPORTER_PORT', None),
+                        type=int,
+                        help='Serve the collected values at /metrics on this port instead of pushing them to the pushgateway (with --daemon)')
     args = parser.parse_args()
 
     if args.verify_access:
         googledrive.verify_access()
         sys.exit(0)
     else:
-        if args.graylog:
-            # ~1 second
-            logs_stats = graylog.stats()
-            prometheus.push("logs", logs_stats, simulate=args.no_push)
-
-        if args.solr:
-            # ~1 second
-            solr_stats = solr.stats()
-            prometheus.push("solr", solr_stats, simulate=args.no_push)
-
-        if args.postgres:
-            # ~5 minutes
-            db_stats = postgres.stats()
-            prometheus.push("master_pipeline_records", db_stats, simulate=args.no_push)
-
-        if args.classic:
-            # ~15 minutes
-            classic_bibcodes = classic.bibcodes()
-            db_bibcodes = postgres.bibcodes()
-            solr_bibcodes = solr.bibcodes()
-            bibcodes_stats, bibcodes_batch = classic.compare(classic_bibcodes, db_bibcodes, solr_bibcodes)
-            prometheus.push("classic", bibcodes_stats, simulate=args.no_push)
-            if not args.no_classic_upload:
-                googledrive.upload(bibcodes_batch, keep_last_n_folders=config.get('GOOGLE_DRIVE_KEEP_LAST_N_FOLDERS', 30))
-
+        selected = [(name, collector) for name, collector in COLLECTORS if getattr(args, name)]
+        if args.daemon:
+            intervals = config.get('COLLECTOR_INTERVALS', {})
+            if not selected:
+                selected = [(name, collector) for name, collector in COLLECTORS if name in intervals]
+            missing = [name for name, _ in selected if name not in intervals]
+            if missing:
+                parser.error("No interval in COLLECTOR_INTERVALS for: {}".format(", ".join(missing)))
+            jobs = {name: (lambda name=name, collector=collector: run_collector(name, collector, args)) for name, collector in selected}
+            if args.exporter_port:
+                prometheus.serve(args.exporter_port)
+            stop = threading.Event()
+            signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+            signal.signal(signal.SIGINT, lambda signum, frame: stop.set())
+            logger.info("Daemon started: %s", ", ".join("{} every {}s".format(name, intervals[name]) for name in jobs))
+            scheduler.daemon(jobs, intervals, max_workers=args.max_workers, timeout=args.timeout, stop=stop)
+            logger.info("Daemon stopped")
+        elif args.parallel:
+            jobs = {name: (lambda name=name, collector=collector: run_collector(name, collector, args)) for name, collector in selected}
+            status = scheduler.run(jobs, max_workers=args.max_workers, timeout=args.timeout)
+            logger.info("Collectors finished: %s", ", ".join("{}={}".format(k, v) for k, v in status.items()))
+        else:
+            for name, collector in selected:
+                run_collector(name, collector, args)
@@ -0,0 +1,361 @@
+"""
+End-to-end benchmark of the collectors against local stand-ins for every data source: fake Solr
+(mbeans, replication, stats and cursorMark/CSV selects), pushgateway, Graylog search API and
+Google Drive API (scripts/fake_drive.py), a scratch postgres schema in the --dsn database filled
+with a synthetic records table (scripts/synthetic_records.py), and a synthetic classic canonical
+file. Every case runs in a fresh process and
+reports its wall time, the requests received by each fake and its peak RSS (the 'baseline' case
+only imports the modules, its RSS should be subtracted from the others).
+"""
+import argparse
+import bisect
+import json
+import logging
+import multiprocessing
+import os
+import re
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+# ============================= INITIALIZATION ==================================== #
+from adsputils import setup_logging, load_config
+proj_home = os.path.realpath(os.path.join(os.path.dirname(__file__), '../'))
+sys.path.insert(0, proj_home)
+config = load_config(proj_home=proj_home)
+logger = setup_logging('benchmark', proj_home=proj_home,
+                        level=config.get('LOGGING_LEVEL', 'INFO'),
+                        attach_stdout=config.get('LOG_STDOUT', False))
+
+from statscollector import solr, postgres, classic, prometheus, graylog, googledrive
+from statscollector.setup import config as statscollector_config
+import fake_drive
+import synthetic_records
+import fulltext
+
+SCHEMA = 'statscollector_e2e_benchmark'
+
+# One record every POSTGRES_MISSING_EVERY (SOLR_MISSING_EVERY) classic bibcodes is missing from
+# postgres (solr), which also have rows // MISSING_EVERY bibcodes that classic does not have
+POSTGRES_MISSING_EVERY = 1000
+SOLR_MISSING_EVERY = 500
+
+# Seconds added to every request received by the fakes, to mimic network latency
+LATENCY = 0.
+
+# Number of requests received by each fake since it started (the Drive ones are in fake_drive.REQUESTS)
+REQUESTS = {'solr': 0, 'pushgateway': 0, 'graylog': 0}
+
+# Sorted bibcodes served by the fake Solr
+SOLR_BIBCODES = []
+
+_lock = threading.Lock()
+
+
+class _FakeHandler(BaseHTTPRequestHandler):
+    """Request counting, latency and response helpers shared by the fake APIs"""
+    protocol_version = 'HTTP/1.1'
+    name = None
+
+    def log_message(self, *args):
+        pass
+
+    def _count(self):
+        time.sleep(LATENCY)
+        with _lock:
+            REQUESTS[self.name] += 1
+
+    def _params(self):
+        return {k: v[0] for k, v in parse_qs(urlparse(self.path).query).items()}
+
+    def _send(self, status, body=b'', content_type='application/json'):
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body)
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class _SolrHandler(_FakeHandler):
+    name = 'solr'
+
+    def do_GET(self):
+        self._count()
+        path = urlparse(self.path).path
+        params = self._params()
+        if path.endswith('/admin/mbeans'):
+            self._send(200, {'solr-mbeans': ['UPDATE', {'updateHandler': {'stats': {
+                'UPDATE.updateHandler.commits.count': 1234,
+                'UPDATE.updateHandler.cumulativeAdds.count': len(SOLR_BIBCODES),
+                'UPDATE.updateHandler.cumulativeErrors.count': 0,
+                'UPDATE.updateHandler.errors': 0,
+            }}}]})
+        elif path.endswith('/replication'):
+            self._send(200, {'details': {'indexSize': '{:.2f} MB'.format(len(SOLR_BIBCODES) / 1000.),
+                                         'leader': {'replicableVersion': 1, 'replicableGeneration': 1}}})
+        elif path.endswith('/select') and params.get('stats') == 'true':
+            self._send(200, {'response': {'numFound': len(SOLR_BIBCODES), 'docs': []},
+                             'stats': {'stats_fields': {'citation_count': {'sum': 10. * len(SOLR_BIBCODES)},
+                                                        'citation_count_norm': {'sum': 2.5 * len(SOLR_BIBCODES)}}}})
+        elif path.endswith('/select'):
+            self._select(params)
+        else:
+            self._send(404, {'error': 'not found'})
+
+    def _select(self, params):
+        """Bibcodes in the fq range (solr._range()), as JSON pages with cursorMark or as CSV"""
+        first, last = 0, len(SOLR_BIBCODES)
+        match = re.search(r'bibcode:([\[{])(\*|"[^"]*") TO (\*|"[^"]*")([\]}])', params.get('fq', ''))
+        if match:
+            lower, upper = match.group(2).strip('"'), match.group(3).strip('"')
+            if lower != '*':
+                first = (bisect.bisect_left if match.group(1) == '[' else bisect.bisect_right)(SOLR_BIBCODES, lower)
+            if upper != '*':
+                last = (bisect.bisect_left if match.group(4) == '}' else bisect.bisect_right)(SOLR_BIBCODES, upper)
+        rows = int(params.get('rows', 10))
+        if params.get('wt') == 'csv':
+            self._send(200, "".join(bibcode + "\n" for bibcode in SOLR_BIBCODES[first:min(first + rows, last)]), content_type='text/plain')
+            return
+        # The cursorMark is the position of the next bibcode
+        cursormark = params.get('cursorMark', '*')
+        start = first if cursormark == '*' else int(cursormark)
+        page = SOLR_BIBCODES[start:min(start + rows, last)]
+        self._send(200, {'nextCursorMark': str(start + len(page)) if page else cursormark,
+                         'response': {'numFound': last - first, 'docs': [{'bibcode': bibcode} for bibcode in page]}})
+
+
+class _PushgatewayHandler(_FakeHandler):
+    name = 'pushgateway'
+
+    def _accept(self):
+        self._count()
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self._send(200, content_type='text/plain')
+
+    do_POST = _accept
+    do_PUT = _accept
+    do_DELETE = _accept
+
+
+class _GraylogHandler(_FakeHandler):
+    name = 'graylog'
+
+    @staticmethod
+    def _count_of(container_name):
+        return 10 * len(container_name)
+
+    def do_GET(self):
+        self._count()
+        path = urlparse(self.path).path
+        params = self._params()
+        if path.endswith('/histogram'):
+            parse = lambda ts: int((datetime.strptime(ts, '%Y-%m-%d %H:%M:%S.%f') - datetime(1970, 1, 1)).total_seconds())
+            first, last = parse(params['from']), parse(params['to'])
+            self._send(200, {'interval': 'minute', 'results': {str(minute): 7 for minute in range(first - first % 60, last + 1, 60)}})
+        elif path.endswith('/terms'):
+            container_names = re.search(r'container_name:\((.*)\)', params.get('query', '')).group(1).split(' OR ')
+            self._send(200, {'terms': {name: self._count_of(name) for name in container_names}, 'total': 1})
+        else:
+            match = re.search(r'container_name:(\w+)$', params.get('query', ''))
+            self._send(200, {'total_results': self._count_of(match.group(1)) if match else 7})
+
+
+def _start(handler):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return 'http://{}:{}/'.format(*server.server_address[:2])
+
+
+def _requests():
+    """Requests received by each fake so far"""
+    with _lock:
+        requests = dict(REQUESTS)
+    requests['drive'] = sum(fake_drive.REQUESTS.values())
+    return requests
+
+
+def _discrepancies(rows):
+    """Batch of discrepancy files as classic.compare() returns it for the synthetic corpus"""
+    prefix = classic._batch_prefix()
+    return {
+        "{}_extra_in_db".format(prefix): synthetic_records.bibcodes(rows, POSTGRES_MISSING_EVERY)[-(rows // POSTGRES_MISSING_EVERY):],
+        "{}_missing_in_db".format(prefix): [synthetic_records.bibcode(i, rows) for i in range(POSTGRES_MISSING_EVERY, rows + 1, POSTGRES_MISSING_EVERY)],
+        "{}_extra_in_solr".format(prefix): synthetic_records.bibcodes(rows, SOLR_MISSING_EVERY)[-(rows // SOLR_MISSING_EVERY):],
+        "{}_missing_in_solr".format(prefix): [synthetic_records.bibcode(i, rows) for i in range(SOLR_MISSING_EVERY, rows + 1, SOLR_MISSING_EVERY)],
+    }
+
+
+def _push_results():
+    """Results shaped like postgres.stats()"""
+    return postgres._stats_results(range(len(postgres.WINDOWED_COLUMNS) + len(postgres.REGISTERED_COLUMNS)))
+
+
+def _classic_compare():
+    results, _ = classic.compare(classic.bibcodes(), postgres.bibcodes(), solr.bibcodes())
+    return results
+
+
+# Name and setup of every case, setup(rows) returning the function that is timed
+CASES = (
+    ('baseline', lambda rows: lambda: None),
+    ('solr.stats', lambda rows: solr.stats),
+    ('solr.bibcodes', lambda rows: lambda: len(solr.bibcodes())),
+    ('postgres.stats', lambda rows: postgres.stats),
+    ('postgres.bibcodes', lambda rows: lambda: sum(1 for _ in postgres.bibcodes())),
+    ('classic.compare', lambda rows: _classic_compare),
+    ('graylog.stats', lambda rows: graylog.stats),
+    ('prometheus.push', lambda rows: lambda results=_push_results(): prometheus.push('benchmark', results)),
+    ('googledrive.upload', lambda rows: lambda batch=_discrepancies(rows): googledrive.upload(batch)),
+    ('fulltext.bibcode_monitoring', lambda rows: lambda: fulltext.bibcode_monitoring(2020, list(synthetic_records.STEMS))),
+    ('fulltext.bibstem_monitoring', lambda rows: lambda: fulltext.bibstem_monitoring(list(synthetic_records.STEMS))),
+)
+
+
+def _run(name, rows, overrides, queue):
+    """Time one case in this (fresh) process and report (result, seconds, peak RSS in MB)"""
+    statscollector_config.update(overrides)
+    # The monitors log every finding
+    fulltext.logger.setLevel(logging.WARNING)
+    function = dict(CASES)[name](rows)
+    start = time.time()
+    try:
+        result = function()
+    except:
+        logger.exception("Benchmark case '%s' failed", name)
+        result = 'failed'
+    elapsed = time.time() - start
+    queue.put((result, elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.))
+
+
+def benchmark(dsn, rows, cases=None, latency=0., keep=False, report_path=None):
+    global LATENCY, SOLR_BIBCODES
+    LATENCY = fake_drive.DELAY = latency
+    tmp_dir = tempfile.mkdtemp(prefix='statscollector_benchmark_')
+    connection = synthetic_records.connect(dsn)
+    try:
+        with open(os.path.join(tmp_dir, 'bibcodes.list.can'), 'w') as f:
+            f.writelines(bibcode + "\n" for bibcode in sorted(synthetic_records.bibcodes(rows)))
+        SOLR_BIBCODES = sorted(synthetic_records.bibcodes(rows, SOLR_MISSING_EVERY))
+        with connection.cursor() as cursor:
+            logger.info('Creating synthetic records table with %s rows', rows)
+            synthetic_records.create_records(cursor, SCHEMA, rows, missing_every=POSTGRES_MISSING_EVERY)
+        fake_drive.write_token(os.path.join(tmp_dir, 'token.json'))
+        drive_url = fake_drive.start()
+
+        # Every state file goes to the scratch directory
+        overrides = {
+            'SOLR_URL': _start(_SolrHandler) + 'solr/collection1/',
+            'PROMETHEUS_PUSHGATEWAY_URL': _start(_PushgatewayHandler),
+            'GRAYLOG_URL': _start(_GraylogHandler),
+            'GOOGLE_DRIVE_DISCOVERY_URL': drive_url + 'discovery/v1/apis/{api}/{apiVersion}/rest',
+            'GOOGLE_DRIVE_TOKEN_FILENAME': os.path.join(tmp_dir, 'token.json'),
+            'GOOGLE_DRIVE_FOLDER_ID': 'benchmark',
+            'GOOGLE_DRIVE_MANIFEST_FILE': os.path.join(tmp_dir, 'google_drive_folders.json'),
+            'CLASSIC_CANONICAL_FILE': os.path.join(tmp_dir, 'bibcodes.list.can'),
+            'CLASSIC_CANONICAL_INDEX_FILE': os.path.join(tmp_dir, 'classic_canonical_index.npz'),
+            'CLASSIC_SNAPSHOT_DIR': os.path.join(tmp_dir, 'classic_snapshots'),
+            'POSTGRES_CHECKPOINT_FILE': os.path.join(tmp_dir, 'postgres_checkpoint.json'),
+            'GRAYLOG_BUCKET_CACHE_FILE': os.path.join(tmp_dir, 'graylog_buckets.json'),
+        }
+        overrides.update(synthetic_records.pool_config(dsn))
+        # Route the pooled connections to the scratch schema (the environment is inherited by the cases)
+        os.environ['PGOPTIONS'] = '-c search_path={0}'.format(SCHEMA)
+
+        # Fresh interpreters, so that the peak RSS only accounts for the case
+        context = multiprocessing.get_context('spawn')
+        report = []
+        for name, _ in CASES:
+            if cases and name not in cases and name != 'baseline':
+                continue
+            before = _requests()
+            queue = context.Queue()
+            process = context.Process(target=_run, args=(name, rows, overrides, queue))
+            process.start()
+            result, elapsed, peak_rss = queue.get()
+            process.join()
+            requests = {source: count - before[source] for source, count in _requests().items() if count > before[source]}
+            logger.info('%s: %.2f s, peak RSS %.1f MB, requests %s (%s)', name, elapsed, peak_rss,
+                        ", ".join("{}={}".format(source, count) for source, count in sorted(requests.items())) or 'none', result)
+            report.append({'case': name, 'seconds': elapsed, 'peak_rss_mb': peak_rss, 'requests': requests, 'result': result})
+        if report_path:
+            with open(report_path, 'w') as f:
+                json.dump({'rows': rows, 'latency': latency, 'cases': report}, f, indent=2, default=str)
+            logger.info('Wrote benchmark report to %s', report_path)
+    finally:
+        if not keep:
+            with connection.cursor() as cursor:
+                cursor.execute("DROP SCHEMA IF EXISTS {0} CASCADE".format(SCHEMA))
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        else:
+            logger.info('Kept schema %s and directory %s', SCHEMA, tmp_dir)
+        connection.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the collectors end to end against local fakes of every data source')
+
+    parser.add_argument('--dsn',
+                        dest='dsn',
+                        action='store',
+                        required=True,
+                        help='Postgres database where the scratch schema is (re)created, e.g. "host=/tmp dbname=benchmark"')
+
+    parser.add_argument('--allow-configured-host',
+                        dest='allow_configured_host',
+                        action='store_true',
+                        default=False,
+                        help='Allow --dsn to point to the configured POSTGRES_HOST (or replica)')
+
+    parser.add_argument('-r',
+                        '--rows',
+                        dest='rows',
+                        action='store',
+                        type=int,
+                        default=100000,
+                        help='Number of synthetic bibcodes in classic (postgres and solr have about as many)')
+
+    parser.add_argument('-c',
+                        '--cases',
+                        dest='cases',
+                        action='store',
+                        default=None,
+                        help='Comma-separated list of cases to run (all by default): {}'.format(", ".join(name for name, _ in CASES)))
+
+    parser.add_argument('-l',
+                        '--latency',
+                        dest='latency',
+                        action='store',
+                        type=float,
+                        default=0.,
+                        help='Seconds added to every request received by the fake APIs')
+
+    parser.add_argument('--keep',
+                        dest='keep',
+                        action='store_true',
+                        default=False,
+                        help='Keep the scratch schema and directory after the benchmark')
+
+    parser.add_argument('-o',
+                        '--output',
+                        dest='output',
+                        action='store',
+                        default=None,
+                        help='Also write the results to this JSON file (e.g. to compare runs)')
+
+    args = parser.parse_args()
+    if not args.allow_configured_host and synthetic_records.targets_configured_host(args.dsn, config):
+        parser.error('--dsn points to the configured POSTGRES_HOST, use --allow-configured-host to run there anyway')
+    if args.cases:
+        args.cases = [x.strip() for x in args.cases.split(',')]
+    benchmark(args.dsn, args.rows, cases=args.cases, latency=args.latency, keep=args.keep, report_path=args.output)
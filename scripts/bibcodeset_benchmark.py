@@ -0,0 +1,78 @@
+import argparse
+import multiprocessing
+import os
+import resource
+import sys
+import time
+
+# ============================= INITIALIZATION ==================================== #
+from adsputils import setup_logging, load_config
+proj_home = os.path.realpath(os.path.join(os.path.dirname(__file__), '../'))
+sys.path.insert(0, proj_home)
+config = load_config(proj_home=proj_home)
+logger = setup_logging('bibcodeset_benchmark', proj_home=proj_home,
+                        level=config.get('LOGGING_LEVEL', 'INFO'),
+                        attach_stdout=config.get('LOG_STDOUT', False))
+
+from statscollector import classic
+
+
+def _synthetic(size, missing_every=None, extra=0, extra_year=2020):
+    """
+    Yield 19-character synthetic bibcodes in ascending order, skipping one every missing_every
+    and appending extra bibcodes (half of them Zenodo records) that classic does not have. The
+    stream stays sorted only if extra_year is after all the other years (like solr), otherwise
+    it needs to be sorted (like postgres).
+    """
+    for i in range(size):
+        if missing_every and i % missing_every == 0:
+            continue
+        yield "{:04}ApJ..{:010}".format(1900 + i * 125 // size, i)
+    for i in range(extra):
+        yield "{:04}{}{:010}".format(extra_year, "zndo." if i % 2 else "MNRAS", size + i)
+
+
+def _compare(compact, size, queue):
+    """Run classic.compare() on the synthetic corpus and report (results, seconds, peak RSS in MB)"""
+    sources = (_synthetic(size),
+               _synthetic(size, missing_every=1000, extra=2000),
+               _synthetic(size, missing_every=500, extra=100, extra_year=2100))
+    start = time.time()
+    if compact is None:
+        # Baseline: only generate the synthetic bibcodes
+        results = sum(1 for source in sources for _ in source)
+    else:
+        classic.config['CLASSIC_COMPACT_SETS'] = compact
+        results, _ = classic.compare(*sources)
+    elapsed = time.time() - start
+    queue.put((results, elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.))
+
+
+def benchmark(size):
+    """
+    Compare python sets against compact BibcodeSets, each one in a fresh process (the baseline
+    only generates the synthetic bibcodes, its time should be subtracted from the others)
+    """
+    context = multiprocessing.get_context('fork')
+    for name, compact in (('baseline', None), ('set', False), ('BibcodeSet', True)):
+        queue = context.Queue()
+        process = context.Process(target=_compare, args=(compact, size, queue))
+        process.start()
+        results, elapsed, peak_rss = queue.get()
+        process.join()
+        logger.info('%s: %s bibcodes compared in %.1f s, peak RSS %.1f MB (%s)', name, size, elapsed, peak_rss, results)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark classic.compare() with python sets and compact bibcode sets')
+
+    parser.add_argument('-s',
+                        '--size',
+                        dest='size',
+                        action='store',
+                        type=int,
+                        default=16000000,
+                        help='Number of synthetic bibcodes in classic')
+
+    args = parser.parse_args()
+    benchmark(args.size)
@@ -0,0 +1,317 @@
+"""
+Local stand-in for the subset of the Google Drive v3 API used by statscollector/googledrive.py
+(files create/list/delete, multipart and resumable media uploads, batch requests), including
+the discovery document the API client is built from. Point GOOGLE_DRIVE_DISCOVERY_URL to
+<url>/discovery/v1/apis/{api}/{apiVersion}/rest and use a token file with a non-expired
+access token (see write_token()).
+"""
+import argparse
+import email
+import itertools
+import json
+import re
+import threading
+import time
+import uuid
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+PAGE_SIZE = 100
+
+FOLDER_MIMETYPE = 'application/vnd.google-apps.folder'
+
+# Seconds added to every request, to mimic the latency of the real API
+DELAY = 0.
+
+# Number of requests received per (method, path) since the server started
+REQUESTS = {}
+
+FILES = {}
+
+_uploads = {}
+_ids = itertools.count(1)
+_lock = threading.Lock()
+
+
+def discovery_document(root_url):
+    """Minimal Drive v3 discovery document, enough for googleapiclient to build the service"""
+    parameter = lambda location, required=False: {'type': 'string', 'location': location, 'required': required}
+    flag = lambda: {'type': 'boolean', 'location': 'query'}
+    return {
+        'kind': 'discovery#restDescription',
+        'discoveryVersion': 'v1',
+        'id': 'drive:v3',
+        'name': 'drive',
+        'version': 'v3',
+        'rootUrl': root_url,
+        'servicePath': 'drive/v3/',
+        'batchPath': 'batch/drive/v3',
+        'parameters': {
+            'alt': {'type': 'string', 'default': 'json', 'location': 'query'},
+            'fields': parameter('query'),
+        },
+        'schemas': {
+            'File': {'id': 'File', 'type': 'object', 'properties': {
+                'id': {'type': 'string'},
+                'name': {'type': 'string'},
+                'mimeType': {'type': 'string'},
+                'parents': {'type': 'array', 'items': {'type': 'string'}},
+            }},
+            'FileList': {'id': 'FileList', 'type': 'object', 'properties': {
+                'files': {'type': 'array', 'items': {'$ref': 'File'}},
+                'nextPageToken': {'type': 'string'},
+            }},
+        },
+        'resources': {
+            'files': {
+                'methods': {
+                    'create': {
+                        'id': 'drive.files.create',
+                        'path': 'files',
+                        'httpMethod': 'POST',
+                        'parameters': {
+                            'supportsTeamDrives': flag(),
+                            'supportsAllDrives': flag(),
+                        },
+                        'request': {'$ref': 'File'},
+                        'response': {'$ref': 'File'},
+                        'supportsMediaUpload': True,
+                        'mediaUpload': {
+                            'accept': ['*/*'],
+                            'maxSize': '5120GB',
+                            'protocols': {
+                                'simple': {'multipart': True, 'path': '/upload/drive/v3/files'},
+                                'resumable': {'multipart': True, 'path': '/resumable/upload/drive/v3/files'},
+                            },
+                        },
+                    },
+                    'list': {
+                        'id': 'drive.files.list',
+                        'path': 'files',
+                        'httpMethod': 'GET',
+                        'parameters': {
+                            'q': parameter('query'),
+                            'orderBy': parameter('query'),
+                            'pageToken': parameter('query'),
+                            'pageSize': {'type': 'integer', 'location': 'query'},
+                            'supportsAllDrives': flag(),
+                            'includeItemsFromAllDrives': flag(),
+                        },
+                        'response': {'$ref': 'FileList'},
+                    },
+                    'delete': {
+                        'id': 'drive.files.delete',
+                        'path': 'files/{fileId}',
+                        'httpMethod': 'DELETE',
+                        'parameters': {
+                            'fileId': parameter('path', required=True),
+                            'supportsAllDrives': flag(),
+                        },
+                        'parameterOrder': ['fileId'],
+                    },
+                },
+            },
+        },
+    }
+
+
+def write_token(path):
+    """Write an oauth2client token file whose access token does not expire during the run"""
+    with open(path, 'w') as f:
+        json.dump({
+            '_module': 'oauth2client.client',
+            '_class': 'OAuth2Credentials',
+            'access_token': 'fake',
+            'client_id': 'fake',
+            'client_secret': 'fake',
+            'refresh_token': 'fake',
+            'token_expiry': '2999-01-01T00:00:00Z',
+            'token_uri': 'https://oauth2.googleapis.com/token',
+            'user_agent': None,
+            'invalid': False,
+        }, f)
+
+
+def _create(metadata, content=None):
+    with _lock:
+        file_id = 'f{}'.format(next(_ids))
+        FILES[file_id] = {
+            'id': file_id,
+            'name': metadata.get('name'),
+            'mimeType': metadata.get('mimeType', 'application/octet-stream'),
+            'parents': metadata.get('parents', []),
+            'modifiedTime': datetime.utcnow().isoformat("T") + "Z",
+            'content': content,
+        }
+    return {k: v for k, v in FILES[file_id].items() if k != 'content'}
+
+
+def _list(params):
+    query = params.get('q', '')
+    parent = re.search(r"'([^']+)' in parents", query)
+    mimetype = re.search(r"mimeType = '([^']+)'", query)
+    older_than = re.search(r"modifiedTime < '([^']+)'", query)
+    with _lock:
+        files = [f for f in FILES.values()
+                 if (not parent or parent.group(1) in f['parents'])
+                 and (not mimetype or f['mimeType'] == mimetype.group(1))
+                 and (not older_than or f['modifiedTime'] < older_than.group(1))]
+    descending = 'desc' in params.get('orderBy', '')
+    files.sort(key=lambda f: (f['modifiedTime'], f['id']), reverse=descending)
+    start = int(params.get('pageToken', 0))
+    size = int(params.get('pageSize', PAGE_SIZE))
+    page = {'files': [{k: f[k] for k in ('id', 'name', 'mimeType')} for f in files[start:start + size]]}
+    if start + size < len(files):
+        page['nextPageToken'] = str(start + size)
+    return page
+
+
+def _delete(file_id):
+    with _lock:
+        return FILES.pop(file_id, None) is not None
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def _count(self):
+        time.sleep(DELAY)
+        with _lock:
+            key = (self.command, urlparse(self.path).path)
+            REQUESTS[key] = REQUESTS.get(key, 0) + 1
+
+    def _body(self):
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def _send(self, status, body=b'', headers=None, content_type='application/json'):
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        if body:
+            self.send_header('Content-Type', content_type)
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self._count()
+        url = urlparse(self.path)
+        params = {k: v[0] for k, v in parse_qs(url.query).items()}
+        if url.path.startswith('/discovery/'):
+            root_url = 'http://{}:{}/'.format(*self.server.server_address[:2])
+            self._send(200, discovery_document(root_url))
+        elif url.path == '/drive/v3/files':
+            self._send(200, _list(params))
+        else:
+            self._send(404, {'error': 'not found'})
+
+    def do_DELETE(self):
+        self._count()
+        match = re.match(r'^/drive/v3/files/([^/?]+)$', urlparse(self.path).path)
+        if match and _delete(match.group(1)):
+            self._send(204)
+        else:
+            self._send(404, {'error': 'not found'})
+
+    def do_POST(self):
+        self._count()
+        url = urlparse(self.path)
+        params = {k: v[0] for k, v in parse_qs(url.query).items()}
+        body = self._body()
+        if url.path == '/drive/v3/files':
+            self._send(200, _create(json.loads(body or b'{}')))
+        elif url.path.endswith('/upload/drive/v3/files') and params.get('uploadType') == 'multipart':
+            message = email.message_from_bytes(b'Content-Type: ' + self.headers['Content-Type'].encode() + b'\r\n\r\n' + body)
+            metadata, media = message.get_payload()
+            self._send(200, _create(json.loads(metadata.get_payload()), media.get_payload(decode=True)))
+        elif url.path.endswith('/upload/drive/v3/files') and params.get('uploadType') == 'resumable':
+            upload_id = uuid.uuid4().hex
+            with _lock:
+                _uploads[upload_id] = {'metadata': json.loads(body or b'{}'), 'content': bytearray()}
+            location = 'http://{}:{}/upload/drive/v3/files?uploadType=resumable&upload_id={}'.format(*self.server.server_address[:2], upload_id)
+            self._send(200, headers={'Location': location})
+        elif url.path == '/batch/drive/v3':
+            self._batch(body)
+        else:
+            self._send(404, {'error': 'not found'})
+
+    def do_PUT(self):
+        self._count()
+        params = {k: v[0] for k, v in parse_qs(urlparse(self.path).query).items()}
+        body = self._body()
+        upload = _uploads.get(params.get('upload_id'))
+        if upload is None:
+            self._send(404, {'error': 'not found'})
+            return
+        # Content-Range: bytes <first>-<last>/<total or *>, or bytes */<total> to query the status
+        match = re.match(r'bytes (?:(\d+)-(\d+)|\*)/(\d+|\*)', self.headers.get('Content-Range', ''))
+        if match and match.group(1) is not None:
+            upload['content'][int(match.group(1)):] = body
+        total = match.group(3) if match else None
+        if total not in (None, '*') and len(upload['content']) >= int(total):
+            with _lock:
+                _uploads.pop(params['upload_id'], None)
+            self._send(200, _create(upload['metadata'], bytes(upload['content'])))
+        else:
+            headers = {'Range': 'bytes=0-{}'.format(len(upload['content']) - 1)} if upload['content'] else {}
+            self._send(308, headers=headers)
+
+    def _batch(self, body):
+        """Run every request of a multipart/mixed batch (only deletions are supported)"""
+        message = email.message_from_bytes(b'Content-Type: ' + self.headers['Content-Type'].encode() + b'\r\n\r\n' + body)
+        boundary = uuid.uuid4().hex
+        parts = []
+        for part in message.get_payload():
+            request_line = part.get_payload().lstrip().split('\r\n', 1)[0].split('\n', 1)[0]
+            method, path = request_line.split(' ')[:2]
+            match = re.match(r'^/drive/v3/files/([^/?]+)', urlparse(path).path)
+            if method == 'DELETE' and match and _delete(match.group(1)):
+                status = '204 No Content'
+            else:
+                status = '404 Not Found'
+            content_id = (part.get('Content-ID') or '').replace('<', '<response-', 1)
+            parts.append('--{}\r\nContent-Type: application/http\r\nContent-ID: {}\r\n\r\nHTTP/1.1 {}\r\nContent-Length: 0\r\n\r\n\r\n'.format(
+                boundary, content_id, status))
+        self._send(200, ("".join(parts) + '--{}--\r\n'.format(boundary)).encode('utf-8'),
+                   content_type='multipart/mixed; boundary={}'.format(boundary))
+
+
+def start(port=0):
+    """Start the fake API in a background thread and return its base URL"""
+    server = ThreadingHTTPServer(('127.0.0.1', port), _Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return 'http://{}:{}/'.format(*server.server_address[:2])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve a local fake Google Drive v3 API')
+
+    parser.add_argument('-p',
+                        '--port',
+                        dest='port',
+                        action='store',
+                        type=int,
+                        default=8765,
+                        help='Port to listen on')
+
+    parser.add_argument('-t',
+                        '--token',
+                        dest='token',
+                        action='store',
+                        default=None,
+                        help='Also write a token file usable with the fake API to this path')
+
+    args = parser.parse_args()
+    if args.token:
+        write_token(args.token)
+    url = start(args.port)
+    print("Set GOOGLE_DRIVE_DISCOVERY_URL = '{}discovery/v1/apis/{{api}}/{{apiVersion}}/rest'".format(url))
+    while True:
+        time.sleep(3600)
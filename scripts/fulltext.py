@@ -1,18 +1,125 @@
 import argparse
 import json
 import os
-import psycopg2
+import sys
 from glob import glob
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 
 # ============================= INITIALIZATION ==================================== #
 from adsputils import setup_logging, load_config
 proj_home = os.path.realpath(os.path.join(os.path.dirname(__file__), '../'))
+sys.path.insert(0, proj_home)
 config = load_config(proj_home=proj_home)
 logger = setup_logging('fulltext', proj_home=proj_home,
                         level=config.get('LOGGING_LEVEL', 'INFO'),
                         attach_stdout=config.get('LOG_STDOUT', False))
 
+from statscollector import pgpool
+
+# All the bibstems of a year at once: every record of the year is matched against the bibstems
+# (prefixes of the bibcode after the year), its fulltext is decoded once, and the per-bibstem
+# statistics are computed with window functions. Only the records without body, the candidate
+# outliers and one row per bibstem (carrying its statistics) are returned. The lengths come
+# either from the records (RECORDS_LENGTHS) or from the summary table (SUMMARY_LENGTHS).
+BIBCODE_MONITORING = """
+WITH bibstems AS (
+    SELECT DISTINCT unnest(%(bibstems)s::text[]) AS bibstem
+), {lengths}, statistics AS (
+    SELECT bibstem, bibcode, has_body, body_length,
+           avg(fulltext_length) FILTER (WHERE has_body) OVER bibstem_window AS avg,
+           stddev_samp(fulltext_length) FILTER (WHERE has_body) OVER bibstem_window AS stddev,
+           row_number() OVER bibstem_window AS position
+    FROM lengths
+    WINDOW bibstem_window AS (PARTITION BY bibstem)
+)
+SELECT bibstem, bibcode, has_body, body_length, avg, stddev
+FROM statistics
+WHERE NOT has_body OR body_length < avg - %(cutoff)s * stddev OR position = 1
+ORDER BY bibstem, bibcode;
+"""
+
+RECORDS_LENGTHS = """matches AS (
+    SELECT b.bibstem, r.bibcode, r.fulltext
+    FROM records AS r
+    CROSS JOIN generate_series(1, (SELECT max(length(bibstem)) FROM bibstems)) AS n
+    JOIN bibstems AS b ON b.bibstem = substring(r.bibcode, 5, n)
+    WHERE r.bibcode >= %(year)s AND r.bibcode < %(next_year)s AND r.fulltext IS NOT NULL
+), decoded AS (
+    -- OFFSET 0 keeps the subquery from being flattened, which would decode the fulltext
+    -- once per reference to the decoded column
+    SELECT bibstem, bibcode, length(fulltext) AS fulltext_length,
+           (regexp_replace(fulltext::text, '\\\\u0000', '', 'g'))::jsonb AS decoded
+    FROM matches
+    OFFSET 0
+), lengths AS (
+    SELECT bibstem, bibcode, fulltext_length, decoded ? 'body' AS has_body, length(decoded->>'body') AS body_length
+    FROM decoded
+)"""
+
+# Derived lengths of every fulltext, maintained by _refresh_summary() from the records whose
+# fulltext_updated changed since the last refresh, so the monitoring does not parse the JSON.
+# Deleted records are only dropped by a rebuild (--rebuild-summary).
+SUMMARY_CREATE = """
+CREATE TABLE IF NOT EXISTS {table} (
+    bibcode varchar(19) PRIMARY KEY,
+    year char(4) NOT NULL,
+    bibstem varchar(5) NOT NULL,
+    has_body boolean NOT NULL,
+    fulltext_length integer NOT NULL,
+    body_length integer,
+    fulltext_updated timestamp with time zone
+);
+CREATE INDEX IF NOT EXISTS {table}_year_idx ON {table} (year);
+CREATE INDEX IF NOT EXISTS {table}_fulltext_updated_idx ON {table} (fulltext_updated);
+"""
+
+SUMMARY_UPSERT = """
+INSERT INTO {table} (bibcode, year, bibstem, has_body, fulltext_length, body_length, fulltext_updated)
+SELECT bibcode, left(bibcode, 4), substring(bibcode, 5, 5), decoded ? 'body', fulltext_length, length(decoded->>'body'), fulltext_updated
+FROM (
+    -- OFFSET 0: decode once (see RECORDS_LENGTHS)
+    SELECT bibcode, length(fulltext) AS fulltext_length,
+           (regexp_replace(fulltext::text, '\\\\u0000', '', 'g'))::jsonb AS decoded, fulltext_updated
+    FROM records
+    WHERE fulltext IS NOT NULL {since}
+    OFFSET 0
+) AS r
+ON CONFLICT (bibcode) DO UPDATE SET has_body = EXCLUDED.has_body,
+                                    fulltext_length = EXCLUDED.fulltext_length,
+                                    body_length = EXCLUDED.body_length,
+                                    fulltext_updated = EXCLUDED.fulltext_updated;
+"""
+
+# Fulltexts removed from the records since the last refresh
+SUMMARY_DELETE = """
+DELETE FROM {table} AS s
+USING records AS r
+WHERE r.bibcode = s.bibcode AND r.fulltext IS NULL AND r.fulltext_updated >= %(since)s;
+"""
+
+SUMMARY_LENGTHS = """lengths AS (
+    SELECT b.bibstem, s.bibcode, s.fulltext_length, s.has_body, s.body_length
+    FROM {table} AS s
+    CROSS JOIN generate_series(1, (SELECT max(length(bibstem)) FROM bibstems)) AS n
+    JOIN bibstems AS b ON b.bibstem = substring(s.bibcode, 5, n)
+    WHERE s.year = %(year)s
+)"""
+
+# Same as the per-bibstem stats_query of _bibstem_findings(), for all the bibstems at once
+SUMMARY_BIBSTEM_MONITORING = """
+WITH bibstems AS (
+    SELECT DISTINCT unnest(%(bibstems)s::text[]) AS bibstem
+)
+SELECT b.bibstem, avg(s.fulltext_length), stddev_samp(s.fulltext_length), s.year, count(*)
+FROM {table} AS s
+CROSS JOIN generate_series(1, (SELECT max(length(bibstem)) FROM bibstems)) AS n
+JOIN bibstems AS b ON b.bibstem = substring(s.bibcode, 5, n)
+WHERE s.year LIKE '20__' AND s.has_body
+GROUP BY b.bibstem, s.year
+ORDER BY b.bibstem, s.year;
+"""
+
 
 def build_input_list():
     """
@@ -31,7 +138,210 @@ def build_input_list():
     return sources
 
 
-def bibcode_monitoring(year, bibstems=None):
+def _log_finding(finding):
+    """Log a finding with the same messages as the original per-bibstem loops"""
+    check = finding['check']
+    if check == 'no_body':
+        logger.info('Bibcode %s has extracted fulltext but no body was extracted.', finding['bibcode'])
+    elif check == 'no_statistics':
+        logger.debug('Bibstem %s has no (or only one) extracted fulltext body for year %s.', finding['bibstem'], finding['year'])
+    elif check == 'short_body':
+        logger.info('Bibcode %s has extracted fulltext but body (length: %s) is short compared '
+                    'to similar bibcodes (avg: %s, stddev: %s)', finding['bibcode'], finding['body_length'], finding['avg'], finding['stddev'])
+    elif check == 'low_count':
+        logger.info('For bibstem %s, year %s has an anomalously low fulltext body count. Count: %s (prior year count: %s)', finding['bibstem'], finding['year'], finding['count'], finding['prior_count'])
+    elif check == 'low_length':
+        logger.info('For bibstem %s, year %s has an anomalously low average body length. Avg: %s (prior year average: %s)', finding['bibstem'], finding['year'], finding['avg'], finding['prior_avg'])
+
+
+def _bibcode_findings(master_cursor, year, bibstem):
+    """Findings of bibcode_monitoring() for one year + bibstem"""
+    findings = []
+    logger.debug('Checking bibcodes from year %s from bibstem %s', year, bibstem)
+    bibstem_year = str(year) + bibstem
+    fulltext_no_null = "(regexp_replace(fulltext::text, '\\\\u0000', '', 'g'))"
+    # for each bibstem, check if any have the fulltext field but are missing the body
+    no_body_query = """
+    SELECT bibcode FROM records 
+    WHERE bibcode LIKE '{0}%' AND fulltext IS NOT NULL AND NOT ({1}::jsonb ? 'body');
+    """.format(bibstem_year, fulltext_no_null)
+    master_cursor.execute(no_body_query)
+    for n in master_cursor.fetchall():
+        findings.append({'check': 'no_body', 'year': str(year), 'bibstem': bibstem, 'bibcode': n[0]})
+
+    # for each bibstem, check the length of the extracted body against the average
+    stats_query = """
+    SELECT avg(length(fulltext)), 
+           stddev_samp(length(fulltext)) 
+    FROM records 
+    WHERE bibcode LIKE '{0}%' AND ({1}::jsonb ? 'body');
+    """.format(bibstem_year, fulltext_no_null)
+    master_cursor.execute(stats_query)
+    avg, stddev = master_cursor.fetchone()
+    if not avg or not stddev:
+        findings.append({'check': 'no_statistics', 'year': str(year), 'bibstem': bibstem})
+        return findings
+    avg = float(avg)
+    stddev = float(stddev)
+
+    body_query = """
+    SELECT bibcode,  length({1}::jsonb->>'body') FROM records 
+    WHERE bibcode LIKE '{0}%' AND ({1}::jsonb ? 'body');
+    """.format(bibstem_year, fulltext_no_null)
+    master_cursor.execute(body_query)
+
+    for bf in master_cursor.fetchall():
+        if bf[1] < avg - (config.get('STDDEV_CUTOFF', 1.5) * stddev):
+            findings.append({'check': 'short_body', 'year': str(year), 'bibstem': bibstem, 'bibcode': bf[0],
+                             'body_length': bf[1], 'avg': avg, 'stddev': stddev})
+    return findings
+
+
+def _refresh_summary(master_cursor, table, rebuild=False):
+    """
+    Bring the summary table up to date with the records whose fulltext_updated is at or after the
+    latest one already summarized, minus FULLTEXT_SUMMARY_REFRESH_MARGIN minutes (the whole table
+    is refilled when empty or with rebuild, which also drops the deleted records)
+
+    fulltext_updated is stamped when the writing transaction starts, so a record can commit after
+    a refresh with an earlier timestamp than the ones already summarized. The margin, longer than
+    those transactions, picks it up on the next refresh; the records summarized again in the
+    margin are only rewritten.
+
+    The first fill decodes every fulltext in one statement, so callers borrow the connection
+    without statement timeout. It is not split in committed batches: a partial fill would have a
+    latest fulltext_updated and the next runs would only refresh from there.
+    """
+    master_cursor.execute(SUMMARY_CREATE.format(table=table))
+    if rebuild:
+        master_cursor.execute("TRUNCATE {table};".format(table=table))
+    master_cursor.execute("SELECT max(fulltext_updated) FROM {table};".format(table=table))
+    since, = master_cursor.fetchone()
+    if since is None:
+        master_cursor.execute(SUMMARY_UPSERT.format(table=table, since=''))
+        upserted, deleted = master_cursor.rowcount, 0
+    else:
+        since -= timedelta(minutes=config.get('FULLTEXT_SUMMARY_REFRESH_MARGIN', 60))
+        master_cursor.execute(SUMMARY_UPSERT.format(table=table, since='AND fulltext_updated >= %(since)s'), {'since': since})
+        upserted = master_cursor.rowcount
+        master_cursor.execute(SUMMARY_DELETE.format(table=table), {'since': since})
+        deleted = master_cursor.rowcount
+    logger.info('Refreshed fulltext summary %s since %s: %s bibcodes updated, %s removed', table, since, upserted, deleted)
+
+
+def _bibcode_findings_set_based(master_cursor, year, bibstems, lengths=RECORDS_LENGTHS):
+    """Findings of bibcode_monitoring() for all the bibstems at once (see BIBCODE_MONITORING)"""
+    cutoff = config.get('STDDEV_CUTOFF', 1.5)
+    results = {}
+    master_cursor.execute(BIBCODE_MONITORING.format(lengths=lengths), {'bibstems': list(bibstems),
+                                                                       'year': str(year),
+                                                                       'next_year': str(int(year) + 1),
+                                                                       'cutoff': cutoff})
+    for bibstem, bibcode, has_body, body_length, avg, stddev in master_cursor:
+        result = results.setdefault(bibstem, {'avg': avg, 'stddev': stddev, 'no_body': [], 'short': []})
+        if not has_body:
+            result['no_body'].append(bibcode)
+        elif avg and stddev and body_length < float(avg) - (cutoff * float(stddev)):
+            result['short'].append((bibcode, body_length))
+
+    # Bibstem by bibstem in the requested order, like the per-bibstem queries
+    findings = []
+    for bibstem in bibstems:
+        result = results.get(bibstem, {'avg': None, 'stddev': None, 'no_body': [], 'short': []})
+        for bibcode in result['no_body']:
+            findings.append({'check': 'no_body', 'year': str(year), 'bibstem': bibstem, 'bibcode': bibcode})
+        if not result['avg'] or not result['stddev']:
+            findings.append({'check': 'no_statistics', 'year': str(year), 'bibstem': bibstem})
+            continue
+        avg = float(result['avg'])
+        stddev = float(result['stddev'])
+        for bibcode, body_length in result['short']:
+            findings.append({'check': 'short_body', 'year': str(year), 'bibstem': bibstem, 'bibcode': bibcode,
+                             'body_length': body_length, 'avg': avg, 'stddev': stddev})
+    return findings
+
+
+def _bibstem_findings(master_cursor, bibstem):
+    """Findings of bibstem_monitoring() for one bibstem"""
+    # for each bibstem, get the average stats on fulltext by year, from 2000 onwards, to compare year-by-year
+    # _ is the single character wildcard for postgres
+    bibstem_year = '20__' + bibstem
+    stats_query = """
+    SELECT avg(length(fulltext)), 
+           stddev_samp(length(fulltext)), 
+           left(bibcode,4) AS year, 
+           count(*) AS num FROM records 
+    WHERE bibcode LIKE '{0}%' AND (fulltext::jsonb ? 'body') GROUP BY left(bibcode,4);
+    """.format(bibstem_year)
+
+    master_cursor.execute(stats_query)
+    return _year_findings(bibstem, master_cursor)
+
+
+def _year_findings(bibstem, rows):
+    """Compare each year of a bibstem with the prior one, rows being (avg, stddev, year, count)"""
+    findings = []
+    avg = []
+    stddev = []
+    years = []
+    num = []
+    for m in rows:
+        avg.append(float(m[0]))
+        stddev.append(float(m[1] or 0))
+        years.append(m[2])
+        num.append(m[3])
+
+    noise = [i**0.5 for i in num]
+    for idx, n in enumerate(noise[:-1]):
+        # check if too few records have an extracted body, compared to prior year
+        if (num[idx] - (config.get('COUNT_ERR', 5) * n)) > num[idx+1]:
+            findings.append({'check': 'low_count', 'bibstem': bibstem, 'year': years[idx+1], 'count': num[idx+1], 'prior_count': num[idx]})
+        # check if the average length of the extracted body is too short, compared to prior year
+        if (avg[idx] - (config.get('STDDEV_CUTOFF', 1.5) * stddev[idx])) > avg[idx+1]:
+            findings.append({'check': 'low_length', 'bibstem': bibstem, 'year': years[idx+1], 'avg': avg[idx+1], 'prior_avg': avg[idx]})
+    return findings
+
+
+def _findings(check, bibstems, workers=1):
+    """
+    Run check(master_cursor, bibstem) for every bibstem, on workers threads each borrowing its own
+    pooled connection, and yield (bibstem, findings) in the order of bibstems (findings is None if
+    the check failed)
+    """
+    def run(bibstem):
+        try:
+            with pgpool.connection() as master_connection, master_connection.cursor() as master_cursor:
+                return check(master_cursor, bibstem)
+        except:
+            logger.exception("Failed retrieving stats from postgres for bibstem %s", bibstem)
+            return None
+
+    if workers > 1:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            # map() hands the results back in submission order
+            yield from zip(bibstems, executor.map(run, bibstems))
+    else:
+        for bibstem in bibstems:
+            yield bibstem, run(bibstem)
+
+
+def _logged(findings):
+    """Log the findings in order (as soon as they are known, runs can be long) and return them"""
+    for finding in findings:
+        _log_finding(finding)
+    return findings
+
+
+def _report(findings, failed, report_path=None, **details):
+    """Write the (already logged) findings as a JSON report when report_path is set"""
+    if report_path:
+        report = dict(details, failed=failed, findings=findings)
+        with open(report_path, 'w') as f:
+            json.dump(report, f, indent=2, default=str)
+        logger.info('Wrote report with %s findings to %s', len(findings), report_path)
+
+
+def bibcode_monitoring(year, bibstems=None, set_based=None, workers=1, report_path=None, summary=None, rebuild_summary=False):
     """
     Monitoring script to check for outlier bibcodes compared to others from the same year + bibstem. To be
     run regularly (weekly or monthly) - logs bibcodes that have no fulltext body extracted (though
@@ -39,133 +349,99 @@ def bibcode_monitoring(year, bibstems=None):
     compared to other bibcodes from the given year + bibstem
     :param year: year to run the script for
     :param bibstems: list of bibstems to run the script for
+    :param set_based: check all the bibstems with a single query (FULLTEXT_SET_BASED by default)
+    :param workers: number of bibstems checked concurrently (without set_based)
+    :param report_path: also write the findings to this JSON file
+    :param summary: refresh the summary table and read the lengths from it (FULLTEXT_SUMMARY by default)
+    :param rebuild_summary: refill the summary table from scratch first
     :return: none (logs output only)
     """
     if not bibstems:
         # get the list of input bibstems
         bibstems = build_input_list()
 
-    master_connection = None
-    try:
-        master_connection = psycopg2.connect(host=host,
-                                             port=port,
-                                             database=master_pipeline_db,
-                                             user=user,
-                                             password=password)
+    if set_based is None:
+        set_based = config.get('FULLTEXT_SET_BASED', False)
+    if summary is None:
+        summary = config.get('FULLTEXT_SUMMARY', False)
 
-        with master_connection.cursor() as master_cursor:
-            for bibstem in bibstems:
-                logger.debug('Checking bibcodes from year %s from bibstem %s', year, bibstem)
-                bibstem_year = str(year) + bibstem
-                fulltext_no_null = "(regexp_replace(fulltext::text, '\\\\u0000', '', 'g'))"
-                # for each bibstem, check if any have the fulltext field but are missing the body
-                no_body_query = """
-                SELECT bibcode FROM records 
-                WHERE bibcode LIKE '{0}%' AND fulltext IS NOT NULL AND NOT ({1}::jsonb ? 'body');
-                """.format(bibstem_year, fulltext_no_null)
-                master_cursor.execute(no_body_query)
-                for n in master_cursor.fetchall():
-                    logger.info('Bibcode %s has extracted fulltext but no body was extracted.', n[0])
-
-                # for each bibstem, check the length of the extracted body against the average
-                stats_query = """
-                SELECT avg(length(fulltext)), 
-                       stddev_samp(length(fulltext)) 
-                FROM records 
-                WHERE bibcode LIKE '{0}%' AND ({1}::jsonb ? 'body');
-                """.format(bibstem_year, fulltext_no_null)
-                master_cursor.execute(stats_query)
-                avg, stddev = master_cursor.fetchone()
-                if not avg or not stddev:
-                    logger.debug('Bibstem %s has no (or only one) extracted fulltext body for year %s.', bibstem, year)
-                    continue
-                avg = float(avg)
-                stddev = float(stddev)
-
-                body_query = """
-                SELECT bibcode,  length({1}::jsonb->>'body') FROM records 
-                WHERE bibcode LIKE '{0}%' AND ({1}::jsonb ? 'body');
-                """.format(bibstem_year, fulltext_no_null)
-                master_cursor.execute(body_query)
-
-                for bf in master_cursor.fetchall():
-                    if bf[1] < avg - (config.get('STDDEV_CUTOFF', 1.5) * stddev):
-                        logger.info('Bibcode %s has extracted fulltext but body (length: %s) is short compared '
-                                    'to similar bibcodes (avg: %s, stddev: %s)', bf[0], bf[1], avg, stddev)
-    except:
-        logger.exception("Failed retrieving stats from postgres")
-    finally:
-        if master_connection is not None:
-            master_connection.close()
-
-def bibstem_monitoring(bibstems=None):
+    findings = []
+    failed = []
+    if summary:
+        table = config.get('FULLTEXT_SUMMARY_TABLE', 'fulltext_summary')
+        try:
+            # Refreshed and read on the primary, a replica could lag behind the refresh
+            with pgpool.connection(readonly=False, replica=False, statement_timeout=0) as master_connection, master_connection.cursor() as master_cursor:
+                _refresh_summary(master_cursor, table, rebuild=rebuild_summary)
+                master_connection.commit()
+                findings = _logged(_bibcode_findings_set_based(master_cursor, year, bibstems, lengths=SUMMARY_LENGTHS.format(table=table)))
+        except:
+            logger.exception("Failed retrieving stats from postgres")
+            failed = list(bibstems)
+    elif set_based:
+        try:
+            with pgpool.connection() as master_connection, master_connection.cursor() as master_cursor:
+                findings = _logged(_bibcode_findings_set_based(master_cursor, year, bibstems))
+        except:
+            logger.exception("Failed retrieving stats from postgres")
+            failed = list(bibstems)
+    else:
+        for bibstem, bibstem_findings in _findings(lambda master_cursor, bibstem: _bibcode_findings(master_cursor, year, bibstem), bibstems, workers=workers):
+            if bibstem_findings is None:
+                failed.append(bibstem)
+            else:
+                findings.extend(_logged(bibstem_findings))
+    _report(findings, failed, report_path=report_path, monitoring='bibcode', year=str(year), bibstems=list(bibstems))
+
+
+def bibstem_monitoring(bibstems=None, workers=1, report_path=None, summary=None, rebuild_summary=False):
     """
     Monitoring script to compare average fulltext output for a given year + bibstem to previous years for the same
     bibstem to check for outlier years. To be run on an ad hoc basis. Logs years + bibstems that have an unusually
     small number of bibcodes with extracted body text, or unusually short body text fields, compared to the prior year
     :param bibstems: List of bibstems to run the script for
+    :param workers: number of bibstems checked concurrently
+    :param report_path: also write the findings to this JSON file
+    :param summary: refresh the summary table and read the lengths from it (FULLTEXT_SUMMARY by default)
+    :param rebuild_summary: refill the summary table from scratch first
     :return: none (logs output only)
     """
     if not bibstems:
         # get the list of input bibstems
         bibstems = build_input_list()
 
-    master_connection = None
-    try:
-        master_connection = psycopg2.connect(host=host,
-                                             port=port,
-                                             database=master_pipeline_db,
-                                             user=user,
-                                             password=password)
+    if summary is None:
+        summary = config.get('FULLTEXT_SUMMARY', False)
 
-        with master_connection.cursor() as master_cursor:
+    findings = []
+    failed = []
+    if summary:
+        table = config.get('FULLTEXT_SUMMARY_TABLE', 'fulltext_summary')
+        try:
+            with pgpool.connection(readonly=False, replica=False, statement_timeout=0) as master_connection, master_connection.cursor() as master_cursor:
+                _refresh_summary(master_cursor, table, rebuild=rebuild_summary)
+                master_connection.commit()
+                master_cursor.execute(SUMMARY_BIBSTEM_MONITORING.format(table=table), {'bibstems': list(bibstems)})
+                rows = {}
+                for bibstem, avg, stddev, year, num in master_cursor:
+                    rows.setdefault(bibstem, []).append((avg, stddev, year, num))
             for bibstem in bibstems:
-                # for each bibstem, get the average stats on fulltext by year, from 2000 onwards, to compare year-by-year
-                # _ is the single character wildcard for postgres
-                bibstem_year = '20__' + bibstem
-                stats_query = """
-                SELECT avg(length(fulltext)), 
-                       stddev_samp(length(fulltext)), 
-                       left(bibcode,4) AS year, 
-                       count(*) AS num FROM records 
-                WHERE bibcode LIKE '{0}%' AND (fulltext::jsonb ? 'body') GROUP BY left(bibcode,4);
-                """.format(bibstem_year)
-
-                master_cursor.execute(stats_query)
-                avg = []
-                stddev = []
-                years = []
-                num = []
-                for m in master_cursor:
-                    avg.append(float(m[0]))
-                    stddev.append(float(m[1]))
-                    years.append(m[2])
-                    num.append(m[3])
-
-                noise = [i**0.5 for i in num]
-                for idx, n in enumerate(noise[:-1]):
-                    # check if too few records have an extracted body, compared to prior year
-                    if (num[idx] - (config.get('COUNT_ERR', 5) * n)) > num[idx+1]:
-                        logger.info('For bibstem %s, year %s has an anomalously low fulltext body count. Count: %s (prior year count: %s)', bibstem, years[idx+1], num[idx+1], num[idx])
-                    # check if the average length of the extracted body is too short, compared to prior year
-                    if (avg[idx] - (config.get('STDDEV_CUTOFF', 1.5) * stddev[idx])) > avg[idx+1]:
-                        logger.info('For bibstem %s, year %s has an anomalously low average body length. Avg: %s (prior year average: %s)', bibstem, years[idx+1], avg[idx+1], avg[idx])
-    except:
-        logger.exception("Failed retrieving stats from postgres")
-    finally:
-        if master_connection is not None:
-            master_connection.close()
+                findings.extend(_logged(_year_findings(bibstem, rows.get(bibstem, []))))
+        except:
+            logger.exception("Failed retrieving stats from postgres")
+            failed = list(bibstems)
+    else:
+        for bibstem, bibstem_findings in _findings(_bibstem_findings, bibstems, workers=workers):
+            if bibstem_findings is None:
+                failed.append(bibstem)
+            else:
+                findings.extend(_logged(bibstem_findings))
+    _report(findings, failed, report_path=report_path, monitoring='bibstem', bibstems=list(bibstems))
 
 
 if __name__ == '__main__':
     # Runs reporting scripts, outputs results to logs
 
-    host = config.get('POSTGRES_HOST')
-    port = config.get('POSTGRES_PORT')
-    user = config.get('POSTGRES_USER')
-    password = config.get('POSTGRES_PASSWORD')
-    master_pipeline_db = config.get('POSTGRES_MASTER_PIPELINE_DB')
-
     parser = argparse.ArgumentParser(description='Process user input.')
 
     parser.add_argument('-y',
@@ -189,20 +465,57 @@ if __name__ == '__main__':
                         default=False,
                         help='For monitoring script, flag to run script for year-by-year historical comparisons')
 
+    parser.add_argument('--set-based',
+                        dest='set_based',
+                        action='store_true',
+                        default=config.get('FULLTEXT_SET_BASED', False),
+                        help='For monitoring script, check all bibstems of the year with a single query')
+
+    parser.add_argument('-w',
+                        '--workers',
+                        dest='workers',
+                        action='store',
+                        type=int,
+                        default=config.get('FULLTEXT_WORKERS', 1),
+                        help='For monitoring script, number of bibstems checked concurrently, each one on its own connection')
+
+    parser.add_argument('-r',
+                        '--report',
+                        dest='report',
+                        action='store',
+                        default=None,
+                        help='For monitoring script, also write the findings to this JSON file')
+
+    parser.add_argument('--summary',
+                        dest='summary',
+                        action='store_true',
+                        default=config.get('FULLTEXT_SUMMARY', False),
+                        help='For monitoring script, refresh the fulltext summary table and read the lengths from it')
+
+    parser.add_argument('--rebuild-summary',
+                        dest='rebuild_summary',
+                        action='store_true',
+                        default=False,
+                        help='For monitoring script, refill the fulltext summary table from scratch, dropping the deleted records (implies --summary)')
+
     args = parser.parse_args()
+    args.summary = args.summary or args.rebuild_summary
 
     if args.bibstem:
         args.bibstem = [x.strip() for x in args.bibstem.split(',')]
 
     if args.historical:
         logger.info(f"Running historical monitoring for {', '.join(args.bibstem) if args.bibstem else 'all'} bibstems.")
-        bibstem_monitoring(args.bibstem)
+        bibstem_monitoring(args.bibstem, workers=args.workers, report_path=args.report,
+                           summary=args.summary, rebuild_summary=args.rebuild_summary)
 
     else:
         if args.year:
             logger.info(f"Running monitoring for {', '.join(args.bibstem) if args.bibstem else 'all'} bibstems for year {args.year}.")
-            bibcode_monitoring(args.year, args.bibstem)
+            bibcode_monitoring(args.year, args.bibstem, set_based=args.set_based, workers=args.workers, report_path=args.report,
+                               summary=args.summary, rebuild_summary=args.rebuild_summary)
         else:
             today = datetime.today()
             logger.info(f"Running monitoring for {', '.join(args.bibstem) if args.bibstem else 'all'} bibstems for current year.")
-            bibcode_monitoring(today.year, args.bibstem)
+            bibcode_monitoring(today.year, args.bibstem, set_based=args.set_based, workers=args.workers, report_path=args.report,
+                               summary=args.summary, rebuild_summary=args.rebuild_summary)
@@ -0,0 +1,189 @@
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import sys
+
+# ============================= INITIALIZATION ==================================== #
+from adsputils import setup_logging, load_config
+proj_home = os.path.realpath(os.path.join(os.path.dirname(__file__), '../'))
+sys.path.insert(0, proj_home)
+config = load_config(proj_home=proj_home)
+logger = setup_logging('postgres_benchmark', proj_home=proj_home,
+                        level=config.get('LOGGING_LEVEL', 'INFO'),
+                        attach_stdout=config.get('LOG_STDOUT', False))
+
+from statscollector import postgres
+from statscollector.setup import config as statscollector_config
+import synthetic_records
+
+SCHEMA = 'statscollector_benchmark'
+
+INDEXES = ('created', 'updated', 'bib_data_updated', 'nonbib_data_updated', 'metrics_updated',
+           'orcid_claims_updated', 'augments_updated', 'fulltext_updated', 'processed',
+           'solr_processed', 'metrics_processed', 'datalinks_processed')
+
+
+def _explain(cursor, query):
+    """Run EXPLAIN ANALYZE on query and return (execution time in ms, shared buffers touched)"""
+    cursor.execute("EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) " + query)
+    plan, = cursor.fetchone()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    plan = plan[0]
+    buffers = plan['Plan'].get('Shared Hit Blocks', 0) + plan['Plan'].get('Shared Read Blocks', 0)
+    return plan['Execution Time'], buffers
+
+
+def _create_records(cursor, rows, indexes=True):
+    logger.info('Creating synthetic records table with %s rows', rows)
+    synthetic_records.create_records(cursor, SCHEMA, rows, indexes=INDEXES if indexes else ())
+
+
+def benchmark_stats(cursor, repeat=3):
+    """
+    Compare the CREATED/UPDATED/PROCESSED/COUNTS queries against the single-pass STATS query
+    on the synthetic records table
+    """
+    cursor.execute("SET search_path TO {0}".format(SCHEMA))
+    queries = {
+        'per-figure': (postgres.CREATED, postgres.UPDATED, postgres.PROCESSED, postgres.COUNTS),
+        'single-scan': (postgres.STATS,),
+    }
+    for name, statements in queries.items():
+        timings = []
+        for _ in range(repeat):
+            total_time, total_buffers = 0., 0
+            for statement in statements:
+                execution_time, buffers = _explain(cursor, statement)
+                total_time += execution_time
+                total_buffers += buffers
+            timings.append((total_time, total_buffers))
+        best_time, best_buffers = min(timings)
+        logger.info('%s: %s queries, best of %s: %.1f ms, %s shared buffers',
+                    name, len(statements), repeat, best_time, best_buffers)
+
+    cursor.execute("SELECT * FROM ({0}) AS c, ({1}) AS u, ({2}) AS p, ({3}) AS r".format(
+        *[q.strip().rstrip(';') for q in queries['per-figure']]))
+    old = cursor.fetchone()
+    cursor.execute(postgres.STATS)
+    new = cursor.fetchone()
+    if tuple(old) != tuple(new):
+        logger.error('Results differ: old %s, new %s', old, new)
+    else:
+        logger.info('Results match')
+
+
+def _client_side_bibcodes(dsn):
+    """Previous postgres.bibcodes(): a plain cursor pulls the whole result set into client memory"""
+    connection = synthetic_records.connect(dsn)
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(postgres.BIBCODES)
+            for bibcode, in cursor:
+                yield bibcode
+    finally:
+        connection.close()
+
+
+def _consume(name, dsn, queue):
+    """Consume the bibcodes without keeping them and report (count, peak RSS in MB)"""
+    generators = {
+        'baseline': lambda: iter(()),
+        'client-side': lambda: _client_side_bibcodes(dsn),
+        'server-side': postgres.bibcodes,
+    }
+    count = sum(1 for _ in generators[name]())
+    queue.put((count, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.))
+
+
+def benchmark_memory(dsn, cursor, rows):
+    """
+    Report the peak RSS of streaming postgres.bibcodes() for growing table sizes, each
+    measurement runs in a fresh process
+    """
+    # Route the connections opened by postgres.bibcodes() to the scratch schema (the forked
+    # processes inherit both)
+    statscollector_config.update(synthetic_records.pool_config(dsn))
+    os.environ['PGOPTIONS'] = '-c search_path={0}'.format(SCHEMA)
+    context = multiprocessing.get_context('fork')
+    for size in (rows // 4, rows // 2, rows):
+        _create_records(cursor, size, indexes=False)
+        for name in ('baseline', 'client-side', 'server-side'):
+            queue = context.Queue()
+            process = context.Process(target=_consume, args=(name, dsn, queue))
+            process.start()
+            count, peak_rss = queue.get()
+            process.join()
+            logger.info('%s rows, %s: %s bibcodes, peak RSS %.1f MB', size, name, count, peak_rss)
+
+
+def benchmark(dsn, rows, repeat=3, indexes=True, keep=False, memory=False):
+    connection = synthetic_records.connect(dsn)
+    try:
+        with connection.cursor() as cursor:
+            if memory:
+                benchmark_memory(dsn, cursor, rows)
+            else:
+                _create_records(cursor, rows, indexes=indexes)
+                benchmark_stats(cursor, repeat=repeat)
+    finally:
+        if not keep:
+            with connection.cursor() as cursor:
+                cursor.execute("DROP SCHEMA IF EXISTS {0} CASCADE".format(SCHEMA))
+        connection.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark postgres.stats() and postgres.bibcodes() on a synthetic records table')
+
+    parser.add_argument('--dsn',
+                        dest='dsn',
+                        action='store',
+                        required=True,
+                        help='Postgres database where the scratch schema is (re)created, e.g. "host=/tmp dbname=benchmark"')
+
+    parser.add_argument('--allow-configured-host',
+                        dest='allow_configured_host',
+                        action='store_true',
+                        default=False,
+                        help='Allow --dsn to point to the configured POSTGRES_HOST (or replica)')
+
+    parser.add_argument('-r',
+                        '--rows',
+                        dest='rows',
+                        action='store',
+                        type=int,
+                        default=1000000,
+                        help='Number of synthetic rows in the records table')
+
+    parser.add_argument('--repeat',
+                        dest='repeat',
+                        action='store',
+                        type=int,
+                        default=3,
+                        help='Number of times each set of queries is run (best time is reported)')
+
+    parser.add_argument('--no-indexes',
+                        dest='indexes',
+                        action='store_false',
+                        default=True,
+                        help='Do not index the timestamp columns')
+
+    parser.add_argument('--keep',
+                        dest='keep',
+                        action='store_true',
+                        default=False,
+                        help='Keep the scratch schema after the benchmark')
+
+    parser.add_argument('--memory',
+                        dest='memory',
+                        action='store_true',
+                        default=False,
+                        help='Measure the peak RSS of postgres.bibcodes() for 1/4, 1/2 and all the rows instead')
+
+    args = parser.parse_args()
+    if not args.allow_configured_host and synthetic_records.targets_configured_host(args.dsn, config):
+        parser.error('--dsn points to the configured POSTGRES_HOST, use --allow-configured-host to run there anyway')
+    benchmark(args.dsn, args.rows, repeat=args.repeat, indexes=args.indexes, keep=args.keep, memory=args.memory)
@@ -0,0 +1,137 @@
+"""
+Scratch postgres schema with a synthetic records table, shared by the benchmarks. They drop and
+refill the schema, so they connect to an explicit DSN (e.g. a local throwaway instance) and
+refuse the configured POSTGRES_HOST unless asked to (see targets_configured_host()).
+"""
+import os
+import psycopg2
+import psycopg2.extensions
+
+STEMS = ('ApJ..', 'MNRAS', 'A&A..', 'PhRvL', 'Natur')
+
+# Synthetic bibcode number i, see bibcode()
+BIBCODE = "lpad((1900 + i::bigint * 125 / %(rows)s)::text, 4, '0') || (%(stems)s::text[])[i %% %(nstems)s + 1] || lpad(i::text, 10, '0')"
+
+CREATE = """
+DROP SCHEMA IF EXISTS {0} CASCADE;
+CREATE SCHEMA {0};
+CREATE TABLE {0}.records (
+    id serial PRIMARY KEY,
+    bibcode varchar(19) UNIQUE NOT NULL,
+    bib_data jsonb,
+    nonbib_data jsonb,
+    metrics jsonb,
+    orcid_claims jsonb,
+    augments jsonb,
+    fulltext text,
+    bib_data_updated timestamp with time zone,
+    nonbib_data_updated timestamp with time zone,
+    metrics_updated timestamp with time zone,
+    orcid_claims_updated timestamp with time zone,
+    augments_updated timestamp with time zone,
+    fulltext_updated timestamp with time zone,
+    created timestamp with time zone,
+    updated timestamp with time zone,
+    processed timestamp with time zone,
+    solr_processed timestamp with time zone,
+    metrics_processed timestamp with time zone,
+    datalinks_processed timestamp with time zone
+);
+"""
+
+# Timestamps spread over the last 30 days (about 1/720 of the rows fall in the hourly interval),
+# 40% of the records have a fulltext (2% of them without body), with body lengths around 3000
+# characters. One bibcode every missing_every is left out and replaced by an extra one at the end.
+FILL = """
+INSERT INTO {0}.records (bibcode, bib_data, nonbib_data, metrics, orcid_claims, augments, fulltext,
+                         bib_data_updated, nonbib_data_updated, metrics_updated, orcid_claims_updated,
+                         augments_updated, fulltext_updated, created, updated, processed,
+                         solr_processed, metrics_processed, datalinks_processed)
+SELECT {1},
+       '{{}}'::jsonb,
+       CASE WHEN random() < 0.95 THEN '{{}}'::jsonb END,
+       CASE WHEN random() < 0.90 THEN '{{}}'::jsonb END,
+       CASE WHEN random() < 0.30 THEN '{{}}'::jsonb END,
+       CASE WHEN random() < 0.50 THEN '{{}}'::jsonb END,
+       CASE WHEN random() < 0.40 THEN
+           CASE WHEN random() < 0.02 THEN '{{"title": "synthetic"}}'
+                ELSE json_build_object('body', repeat('x', greatest(1, (3000 + 1200 * (random() + random() + random() - 1.5))::int)))::text
+           END
+       END,
+       NOW() - random() * INTERVAL '30 days',
+       NOW() - random() * INTERVAL '30 days',
+       NOW() - random() * INTERVAL '30 days',
+       NOW() - random() * INTERVAL '30 days',
+       NOW() - random() * INTERVAL '30 days',
+       NOW() - random() * INTERVAL '30 days',
+       NOW() - random() * INTERVAL '30 days',
+       NOW() - random() * INTERVAL '30 days',
+       NOW() - random() * INTERVAL '30 days',
+       NOW() - random() * INTERVAL '30 days',
+       NOW() - random() * INTERVAL '30 days',
+       NOW() - random() * INTERVAL '30 days'
+FROM (
+    SELECT i FROM generate_series(1, %(rows)s) AS i WHERE i %% %(missing_every)s <> 0
+    UNION ALL
+    SELECT i FROM generate_series(%(rows)s + 1, %(rows)s + %(rows)s / %(missing_every)s) AS i
+) AS ids;
+"""
+
+
+def bibcode(i, rows):
+    """Synthetic 19-character bibcode number i of a corpus of rows bibcodes (same as BIBCODE)"""
+    return "{:04}{}{:010}".format(1900 + i * 125 // rows, STEMS[i % len(STEMS)], i)
+
+
+def bibcodes(rows, missing_every=None):
+    """Classic bibcodes (missing_every None), or those of a source missing one every missing_every and having extra ones"""
+    if missing_every is None:
+        return [bibcode(i, rows) for i in range(1, rows + 1)]
+    result = [bibcode(i, rows) for i in range(1, rows + 1) if i % missing_every != 0]
+    result.extend(bibcode(i, rows) for i in range(rows + 1, rows + rows // missing_every + 1))
+    return result
+
+
+def create_records(cursor, schema, rows, missing_every=None, indexes=()):
+    """(Re)create schema with a records table of synthetic bibcodes(rows, missing_every), indexing the given columns"""
+    cursor.execute(CREATE.format(schema))
+    cursor.execute(FILL.format(schema, BIBCODE), {'rows': rows, 'stems': list(STEMS), 'nstems': len(STEMS),
+                                                  'missing_every': missing_every or rows + 1})
+    for column in indexes:
+        cursor.execute("CREATE INDEX ON {0}.records ({1})".format(schema, column))
+    cursor.execute("ANALYZE {0}.records".format(schema))
+
+
+def connect(dsn):
+    connection = psycopg2.connect(dsn)
+    connection.autocommit = True
+    return connection
+
+
+def _host_and_port(host, port):
+    # No host means the default (local) server, no port the default one
+    return (host or os.environ.get('PGHOST') or 'localhost', str(port or os.environ.get('PGPORT') or 5432))
+
+
+def targets_configured_host(dsn, config):
+    """True if dsn points to the configured POSTGRES_HOST or POSTGRES_REPLICA_HOST (and port)"""
+    params = psycopg2.extensions.parse_dsn(dsn)
+    target = _host_and_port(params.get('host'), params.get('port'))
+    configured = [_host_and_port(config.get('POSTGRES_HOST'), config.get('POSTGRES_PORT'))]
+    if config.get('POSTGRES_REPLICA_HOST'):
+        configured.append(_host_and_port(config.get('POSTGRES_REPLICA_HOST'),
+                                         config.get('POSTGRES_REPLICA_PORT', config.get('POSTGRES_PORT'))))
+    return target in configured
+
+
+def pool_config(dsn):
+    """statscollector config entries routing the pooled connections (statscollector/pgpool.py) to dsn"""
+    params = psycopg2.extensions.parse_dsn(dsn)
+    return {
+        'POSTGRES_HOST': params.get('host'),
+        'POSTGRES_PORT': params.get('port'),
+        'POSTGRES_MASTER_PIPELINE_DB': params.get('dbname'),
+        'POSTGRES_USER': params.get('user'),
+        'POSTGRES_PASSWORD': params.get('password'),
+        'POSTGRES_REPLICA_HOST': None,
+    }
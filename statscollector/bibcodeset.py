@@ -0,0 +1,121 @@
+import os
+import numpy as np
+from itertools import islice
+
+BIBCODE_LENGTH = 19
+
+
+class BibcodeSet:
+    """
+    Immutable set of bibcodes stored as a sorted array of fixed-width 19-byte ASCII strings
+    (about 19 bytes per bibcode instead of ~100 for a str in a python set)
+
+    It supports the subset of the set API used by classic.compare(): len(), membership,
+    iteration (as str, in ascending order), difference(), union() and intersection().
+    """
+
+    def __init__(self, array=None):
+        if array is None:
+            array = np.empty(0, dtype='S{}'.format(BIBCODE_LENGTH))
+        self.array = array
+
+    @classmethod
+    def from_iterable(cls, bibcodes, chunk_size=1000000):
+        """Build the set from any iterable of str bibcodes (e.g. a generator), chunk_size bibcodes at a time"""
+        chunks = []
+        bibcodes = iter(bibcodes)
+        while True:
+            chunk = list(islice(bibcodes, chunk_size))
+            if not chunk:
+                break
+            chunks.append(cls._to_array(chunk))
+        if not chunks:
+            return cls()
+        array = np.concatenate(chunks) if len(chunks) > 1 else chunks[0]
+        del chunks
+        return cls(cls._sorted_unique(array))
+
+    @staticmethod
+    def _sorted_unique(array):
+        if len(array) > 1 and not np.all(array[1:] >= array[:-1]):
+            # Sorted sources (classic file, solr) skip the sort
+            array.sort()
+        if len(array) > 1:
+            # Drop duplicates from the sorted array
+            array = array[np.concatenate(([True], array[1:] != array[:-1]))]
+        return array
+
+    @classmethod
+    def load(cls, path):
+        """Load a set saved with save()"""
+        return cls(np.load(path, allow_pickle=False))
+
+    def save(self, path):
+        """Save the sorted array as a .npy file (replaced atomically)"""
+        tmp_path = path + ".tmp.npy"
+        np.save(tmp_path, self.array, allow_pickle=False)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def _to_array(bibcodes):
+        """Pack str bibcodes into one NUL-padded buffer, avoiding per-item numpy conversions"""
+        if max(map(len, bibcodes)) > BIBCODE_LENGTH:
+            raise ValueError("Bibcodes longer than {} characters are not supported".format(BIBCODE_LENGTH))
+        if min(map(len, bibcodes)) < BIBCODE_LENGTH:
+            bibcodes = [bibcode.ljust(BIBCODE_LENGTH, '\0') for bibcode in bibcodes]
+        packed = "".join(bibcodes).encode('ascii')
+        return np.frombuffer(packed, dtype='S{}'.format(BIBCODE_LENGTH)).copy()
+
+    @staticmethod
+    def _encode(bibcode):
+        return bibcode.encode('ascii') if isinstance(bibcode, str) else bibcode
+
+    def __len__(self):
+        return len(self.array)
+
+    def __iter__(self):
+        for bibcode in self.array:
+            yield bibcode.decode('ascii')
+
+    def __contains__(self, bibcode):
+        bibcode = self._encode(bibcode)
+        i = np.searchsorted(self.array, bibcode)
+        return bool(i < len(self.array) and self.array[i] == bibcode)
+
+    def _found(self, values):
+        """Boolean mask of the values (a sorted or unsorted S19 array) present in this set"""
+        found = np.zeros(len(values), dtype=bool)
+        if len(self.array) == 0:
+            return found
+        i = np.searchsorted(self.array, values)
+        valid = i < len(self.array)
+        found[valid] = self.array[i[valid]] == values[valid]
+        return found
+
+    def isin(self, bibcodes):
+        """Vectorized membership, returns a boolean array with one entry per bibcode"""
+        return self._found(np.array([self._encode(b) for b in bibcodes], dtype='S{}'.format(BIBCODE_LENGTH)))
+
+    def difference(self, other):
+        if not isinstance(other, BibcodeSet):
+            other = BibcodeSet.from_iterable(other)
+        return BibcodeSet(self.array[~other._found(self.array)])
+
+    def union(self, other):
+        if not isinstance(other, BibcodeSet):
+            other = BibcodeSet.from_iterable(other)
+        return BibcodeSet(self._sorted_unique(np.concatenate((self.array, other.array))))
+
+    def intersection(self, other):
+        if not isinstance(other, BibcodeSet):
+            other = BibcodeSet.from_iterable(other)
+        return BibcodeSet(self.array[other._found(self.array)])
+
+    def exclude(self, substring):
+        """Bibcodes not containing substring (e.g. to filter out 'zndo' records)"""
+        mask = np.char.find(self.array, self._encode(substring)) == -1
+        return BibcodeSet(self.array[mask])
+
+    @property
+    def nbytes(self):
+        return self.array.nbytes
@@ -0,0 +1,159 @@
+import os
+import mmap
+import numpy as np
+from .bibcodeset import BibcodeSet, BIBCODE_LENGTH
+from .setup import logger
+
+NEWLINE = ord('\n')
+
+
+class CanonicalFile:
+    """
+    Memory-mapped, read-only view of the classic canonical bibcode file (one bibcode per line)
+
+    Records are exposed as a zero-copy sequence of str. When all the lines have the same width
+    (the usual 19-character bibcode plus newline) records are located by arithmetic, otherwise
+    through an array of line offsets. The record layout and the sortedness of the file are kept
+    in a sidecar index keyed on the file mtime and size, so an unchanged file is not rescanned.
+    """
+
+    def __init__(self, path, index_path=None):
+        self.path = path
+        self.index_path = index_path
+        self._file = open(path, 'rb')
+        stat = os.fstat(self._file.fileno())
+        self.mtime_ns = stat.st_mtime_ns
+        self.size = stat.st_size
+        if self.size > 0:
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            self._buffer = np.frombuffer(self._mmap, dtype=np.uint8)
+        else:
+            self._mmap = None
+            self._buffer = np.empty(0, dtype=np.uint8)
+        if not self._load_index():
+            self._build_index()
+            self._save_index()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        # Views on the mmap have to be released before closing it
+        self._buffer = None
+        self._records = None
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        self._file.close()
+
+    def _load_index(self):
+        if not self.index_path or not os.path.exists(self.index_path):
+            return False
+        try:
+            with np.load(self.index_path) as index:
+                if int(index['mtime_ns']) != self.mtime_ns or int(index['size']) != self.size:
+                    return False
+                self.width = int(index['width'])
+                self.is_sorted = bool(index['is_sorted'])
+                self.is_unique = bool(index['is_unique'])
+                self._offsets = index['offsets'] if self.width == 0 else None
+        except Exception:
+            logger.exception("Ignoring unreadable canonical index '%s'", self.index_path)
+            return False
+        self._set_records()
+        return True
+
+    def _save_index(self):
+        if not self.index_path:
+            return
+        try:
+            tmp_path = self.index_path + ".tmp.npz"
+            np.savez(tmp_path,
+                     mtime_ns=self.mtime_ns,
+                     size=self.size,
+                     width=self.width,
+                     is_sorted=self.is_sorted,
+                     is_unique=self.is_unique,
+                     offsets=self._offsets if self._offsets is not None else np.empty(0, dtype=np.int64))
+            os.replace(tmp_path, self.index_path)
+        except Exception:
+            logger.exception("Unable to save canonical index '%s'", self.index_path)
+
+    def _build_index(self):
+        newlines = np.flatnonzero(self._buffer == NEWLINE)
+        self.width = 0
+        self._offsets = None
+        if len(newlines) > 0 and self.size % (newlines[0] + 1) == 0 and len(newlines) == self.size // (newlines[0] + 1):
+            width = int(newlines[0]) + 1
+            if np.all(newlines == np.arange(width - 1, self.size, width)):
+                self.width = width
+        if self.width == 0:
+            # Start of every line (a last line without newline included)
+            starts = np.concatenate(([0], newlines + 1))
+            if starts[-1] >= self.size:
+                starts = starts[:-1]
+            self._offsets = starts.astype(np.int64)
+        self._set_records()
+        if self._records is not None:
+            self.is_sorted = bool(np.all(self._records[1:] >= self._records[:-1]))
+            self.is_unique = bool(np.all(self._records[1:] > self._records[:-1]))
+        else:
+            previous = None
+            self.is_sorted = self.is_unique = True
+            for bibcode in self:
+                if previous is not None:
+                    self.is_sorted = self.is_sorted and bibcode >= previous
+                    self.is_unique = self.is_unique and bibcode > previous
+                previous = bibcode
+        logger.debug("Indexed canonical file '%s' (width %s, sorted %s)", self.path, self.width, self.is_sorted)
+
+    def _set_records(self):
+        """Fixed-width records (line ending included), which sort as the bibcodes they hold"""
+        if self.width > 0:
+            self._records = self._buffer.view('S{}'.format(self.width))
+            # CRLF or LF, as found at the end of the first record
+            self._line_ending = b'\r\n' if self.width > 1 and self._buffer[self.width - 2] == ord('\r') else b'\n'
+        else:
+            self._records = None
+
+    def __len__(self):
+        if self.width > 0:
+            return self.size // self.width
+        return len(self._offsets)
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        if self.width > 0:
+            start, end = i * self.width, (i + 1) * self.width
+        else:
+            start = self._offsets[i]
+            end = self._offsets[i + 1] if i + 1 < len(self._offsets) else self.size
+        return self._mmap[start:end].decode('ascii').strip()
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __contains__(self, bibcode):
+        if self._records is not None and self.is_sorted:
+            # Binary search on the records, padded like them
+            record = bibcode.encode('ascii').ljust(self.width - len(self._line_ending)) + self._line_ending
+            if len(record) != self.width:
+                return False
+            i = np.searchsorted(self._records, record)
+            return bool(i < len(self._records) and self._records[i] == record)
+        return any(b == bibcode for b in self)
+
+    def to_bibcodeset(self):
+        """Copy the bibcodes into a BibcodeSet, straight from the mapped records when possible"""
+        if self._records is not None and self.width == BIBCODE_LENGTH + len(self._line_ending) and self.is_unique:
+            records = self._buffer.view([('bibcode', 'S{}'.format(BIBCODE_LENGTH)), ('newline', 'S{}'.format(len(self._line_ending)))])
+            # Always a copy, a view would keep the mmap from being closed
+            return BibcodeSet(records['bibcode'].copy())
+        return BibcodeSet.from_iterable(iter(self))
@@ -1,30 +1,92 @@
-from datetime import datetime
+import os
+import json
+import heapq
+from itertools import groupby
+from datetime import datetime, timedelta
+from . import postgres
+from . import solr
+from . import instrumentation
+from .bibcodeset import BibcodeSet
+from .canonical import CanonicalFile
 from .setup import config, logger
 
 def bibcodes():
     try:
-        with open(config.get('CLASSIC_CANONICAL_FILE'), "r") as f:
+        with instrumentation.timed('classic', 'bibcodes') as fetched, open(config.get('CLASSIC_CANONICAL_FILE'), "r") as f:
             bibcodes = [line.strip() for line in f]
+            fetched['rows'] += len(bibcodes)
     except:
         logger.exception("Unable to retreive bibcodes from classic")
         return []
     else:
         return bibcodes
 
-def compare(classic_bibcodes, db_bibcodes, solr_bibcodes):
-    """Compare bibcode lists against classic"""
+def _canonical_file():
+    return CanonicalFile(config.get('CLASSIC_CANONICAL_FILE'), config.get('CLASSIC_CANONICAL_INDEX_FILE', None))
+
+def sorted_bibcodes():
+    """
+    Stream classic bibcodes in ascending order (exceptions are propagated)
+
+    The canonical file is streamed as is if its (cached) index says it is sorted, otherwise it
+    gets sorted in memory.
+    """
+    with _canonical_file() as canonical:
+        if canonical.is_sorted:
+            yield from canonical
+        else:
+            yield from sorted(canonical)
+
+def bibcodeset():
+    """Classic bibcodes as a BibcodeSet, copied from the memory-mapped canonical file"""
+    try:
+        with instrumentation.timed('classic', 'bibcodes') as fetched, _canonical_file() as canonical:
+            bibcodes = canonical.to_bibcodeset()
+            fetched['rows'] += len(bibcodes)
+            return bibcodes
+    except:
+        logger.exception("Unable to retreive bibcodes from classic")
+        return BibcodeSet()
+
+def _batch_prefix():
+    now = datetime.utcnow()
+    return "{:04}{:02}{:02}_{:02}{:02}".format(now.year, now.month, now.day, now.hour, now.minute)
+
+def _as_set(bibcodes, name, compact=None):
+    """
+    Materialise a bibcode list or stream as a set (or a compact BibcodeSet if CLASSIC_COMPACT_SETS
+    is enabled), a stream that fails is considered empty
+    """
+    if isinstance(bibcodes, BibcodeSet):
+        return bibcodes
+    if compact is None:
+        compact = config.get('CLASSIC_COMPACT_SETS', False)
+    try:
+        if compact:
+            return BibcodeSet.from_iterable(bibcodes)
+        return set(bibcodes)
+    except Exception:
+        logger.exception("Unable to retrieve bibcodes from %s", name)
+        return BibcodeSet() if compact else set()
+
+def _exclude_zenodo(bibcodes):
+    """Filter out non-classic Zenodo records"""
+    if isinstance(bibcodes, BibcodeSet):
+        return bibcodes.exclude("zndo")
+    return [e for e in bibcodes if "zndo" not in e]
+
+def compare(classic_bibcodes, db_bibcodes, solr_bibcodes, prefix=None):
+    """Compare bibcode lists (or streams) against classic"""
     results = {}
     batch = {}
-    now = datetime.utcnow()
-    prefix = "{:04}{:02}{:02}_{:02}{:02}".format(now.year, now.month, now.day, now.hour, now.minute)
+    if prefix is None:
+        prefix = _batch_prefix()
 
+    classic_bibcodes = _as_set(classic_bibcodes, 'classic')
     if len(classic_bibcodes) > 0:
-        classic_bibcodes = set(classic_bibcodes)
-
+        db_bibcodes = _as_set(db_bibcodes, 'db')
         if len(db_bibcodes) > 0:
-            db_bibcodes = set(db_bibcodes)
-            extra_in_db = db_bibcodes.difference(classic_bibcodes)
-            extra_in_db = [e for e in extra_in_db if "zndo" not in e] # Filter out non-classic Zenodo records
+            extra_in_db = _exclude_zenodo(db_bibcodes.difference(classic_bibcodes))
             missing_in_db = classic_bibcodes.difference(db_bibcodes)
             results['extra_in_db'] = len(extra_in_db)
             results['missing_in_db'] = len(missing_in_db)
@@ -32,10 +94,9 @@ def compare(classic_bibcodes, db_bibcodes, solr_bibcodes):
             extra_in_db = set()
             missing_in_db = set()
 
+        solr_bibcodes = _as_set(solr_bibcodes, 'solr')
         if len(solr_bibcodes) > 0:
-            solr_bibcodes = set(solr_bibcodes)
-            extra_in_solr = solr_bibcodes.difference(classic_bibcodes)
-            extra_in_solr = [e for e in extra_in_solr if "zndo" not in e] # Filter out non-classic Zenodo records
+            extra_in_solr = _exclude_zenodo(solr_bibcodes.difference(classic_bibcodes))
             missing_in_solr = classic_bibcodes.difference(solr_bibcodes)
             results['extra_in_solr'] = len(extra_in_solr)
             results['missing_in_solr'] = len(missing_in_solr)
@@ -51,3 +112,154 @@ def compare(classic_bibcodes, db_bibcodes, solr_bibcodes):
         })
 
     return results, batch
+
+
+class _SortedSource:
+    """Wrap a sorted bibcode iterable, stopping it (and flagging it as failed) on errors or unsorted input"""
+
+    def __init__(self, name, bibcodes):
+        self.name = name
+        self.bibcodes = bibcodes
+        self.count = 0
+        self.failed = False
+
+    def __iter__(self):
+        last = None
+        try:
+            for bibcode in self.bibcodes:
+                if last is not None and bibcode < last:
+                    raise ValueError("'{}' is not sorted ('{}' after '{}')".format(self.name, bibcode, last))
+                last = bibcode
+                self.count += 1
+                yield bibcode, self.name
+        except Exception:
+            logger.exception("Unable to retrieve sorted bibcodes from %s", self.name)
+            self.failed = True
+
+def compare_sorted(classic_bibcodes, db_bibcodes, solr_bibcodes):
+    """
+    Compare sorted bibcode iterables against classic with a k-way merge, so that only the
+    discrepancies are kept in memory. Results and batch match compare() on the same bibcodes.
+    """
+    sources = [_SortedSource(name, bibcodes) for name, bibcodes in (('classic', classic_bibcodes), ('db', db_bibcodes), ('solr', solr_bibcodes))]
+    compared = {source.name: source for source in sources[1:]}
+    discrepancies = {
+        'extra_in_db': [],
+        'missing_in_db': [],
+        'extra_in_solr': [],
+        'missing_in_solr': [],
+    }
+    merged = heapq.merge(*sources)
+    for bibcode, group in groupby(merged, key=lambda x: x[0]):
+        found = {name for _, name in group}
+        in_classic = 'classic' in found
+        for name, source in compared.items():
+            if source.failed:
+                continue
+            if name in found and not in_classic:
+                if "zndo" not in bibcode: # Filter out non-classic Zenodo records
+                    discrepancies['extra_in_' + name].append(bibcode)
+            elif in_classic and name not in found:
+                discrepancies['missing_in_' + name].append(bibcode)
+
+    results = {}
+    batch = {}
+    classic_source, db_source, solr_source = sources
+    if not classic_source.failed and classic_source.count > 0:
+        for source in (db_source, solr_source):
+            if not source.failed and source.count > 0:
+                results['extra_in_' + source.name] = len(discrepancies['extra_in_' + source.name])
+                results['missing_in_' + source.name] = len(discrepancies['missing_in_' + source.name])
+            else:
+                discrepancies['extra_in_' + source.name] = set()
+                discrepancies['missing_in_' + source.name] = set()
+        prefix = _batch_prefix()
+        batch.update({"{}_{}".format(prefix, key): value for key, value in discrepancies.items()})
+
+    return results, batch
+
+
+DISCREPANCIES = ('extra_in_db', 'missing_in_db', 'extra_in_solr', 'missing_in_solr')
+
+def _load_snapshot(snapshot_dir, name):
+    path = os.path.join(snapshot_dir, name + ".npy")
+    if not os.path.exists(path):
+        return None
+    try:
+        return BibcodeSet.load(path)
+    except:
+        logger.exception("Ignoring unreadable snapshot '%s'", path)
+        return None
+
+def _db_bibcodeset(snapshot_dir, meta):
+    """
+    Postgres bibcodes, extending the previous snapshot with the records whose bib_data was
+    updated since then. Deleted records are only dropped by the full refresh done every
+    CLASSIC_SNAPSHOT_DB_REFRESH_INTERVAL hours. If the update query fails, all the bibcodes are
+    reloaded instead (an empty set if that fails too, which is then neither saved nor used to
+    advance the snapshot timestamp).
+    """
+    now = postgres.now()
+    previous = _load_snapshot(snapshot_dir, 'db')
+    refreshed = meta.get('db_refreshed')
+    refresh_interval = timedelta(hours=config.get('CLASSIC_SNAPSHOT_DB_REFRESH_INTERVAL', 168))
+    if previous is not None and len(previous) > 0 and refreshed and now - datetime.fromisoformat(refreshed) < refresh_interval:
+        try:
+            # Not through _as_set(), which would turn a failure into an empty update
+            updated = BibcodeSet.from_iterable(postgres.bibcodes(since=datetime.fromisoformat(meta['db_timestamp'])))
+        except Exception:
+            logger.exception("Unable to retrieve updated bibcodes from db, reloading all of them")
+        else:
+            return previous.union(updated), now, datetime.fromisoformat(refreshed)
+    return _as_set(postgres.bibcodes(), 'db', compact=True), now, now
+
+def compare_snapshot(snapshot_dir):
+    """
+    Compare postgres and solr against classic like compare(), keeping a snapshot of the postgres
+    bibcodes (extended incrementally on the next run) and of the discrepancies in snapshot_dir.
+    Besides the totals, the results (and batch) include the discrepancies that are new or
+    resolved since the previous snapshot. Classic and solr are reloaded on every run, so they
+    are not kept.
+    """
+    os.makedirs(snapshot_dir, exist_ok=True)
+    meta_path = os.path.join(snapshot_dir, "meta.json")
+    try:
+        with open(meta_path, "r") as f:
+            meta = json.load(f)
+    except FileNotFoundError:
+        meta = {}
+
+    sources = {'classic': bibcodeset()}
+    try:
+        sources['db'], db_timestamp, db_refreshed = _db_bibcodeset(snapshot_dir, meta)
+    except:
+        logger.exception("Unable to retrieve bibcodes from db")
+        sources['db'] = BibcodeSet()
+    sources['solr'] = _as_set(solr.sorted_bibcodes(), 'solr', compact=True)
+
+    prefix = _batch_prefix()
+    results, batch = compare(sources['classic'], sources['db'], sources['solr'], prefix=prefix)
+
+    for name in DISCREPANCIES:
+        if name not in results:
+            # Source not compared this time, keep its previous snapshot
+            continue
+        current = _as_set(batch["{}_{}".format(prefix, name)], name, compact=True)
+        previous = _load_snapshot(snapshot_dir, name)
+        if previous is not None:
+            new = current.difference(previous)
+            resolved = previous.difference(current)
+            results['new_' + name] = len(new)
+            results['resolved_' + name] = len(resolved)
+            batch["{}_new_{}".format(prefix, name)] = new
+            batch["{}_resolved_{}".format(prefix, name)] = resolved
+        current.save(os.path.join(snapshot_dir, name + ".npy"))
+
+    if len(sources['db']) > 0:
+        sources['db'].save(os.path.join(snapshot_dir, "db.npy"))
+        meta['db_timestamp'] = db_timestamp.isoformat()
+        meta['db_refreshed'] = db_refreshed.isoformat()
+        with open(meta_path, "w") as f:
+            json.dump(meta, f)
+
+    return results, batch
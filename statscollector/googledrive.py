@@ -1,14 +1,61 @@
+import io
 import os
 import re
+import json
+import zlib
 import tempfile
+import threading
 from datetime import datetime
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
 from dateutil.relativedelta import relativedelta as tsdelta
-from apiclient.discovery import build
+from apiclient.discovery import build_from_document, DISCOVERY_URI
+from apiclient.http import MediaUpload, MediaIoBaseUpload
 from apiclient import errors
 from httplib2 import Http
 from oauth2client import file, client, tools
+from . import instrumentation
 from .setup import config, logger
 
+_credentials = None
+_discovery = None
+_lock = threading.Lock()
+_local = threading.local()
+
+def _get_service():
+    """
+    Drive service of the current thread (httplib2 transports cannot be shared between threads),
+    the token and the API discovery document being loaded only once per process
+    """
+    global _credentials, _discovery
+    service = getattr(_local, 'service', None)
+    if service is not None:
+        return service
+    with _lock:
+        if _credentials is None:
+            if not os.path.exists(config.get('GOOGLE_DRIVE_TOKEN_FILENAME')):
+                return None
+            _credentials = file.Storage(config.get('GOOGLE_DRIVE_TOKEN_FILENAME')).get()
+        transport = Http(timeout=config.get('GOOGLE_DRIVE_TIMEOUT', 60))
+        if hasattr(transport, 'redirect_codes'):
+            # Recent httplib2 versions follow 308, which resumable uploads use to report progress
+            transport.redirect_codes = transport.redirect_codes - {308}
+        http = _credentials.authorize(transport)
+        request = http.request
+        def counted_request(*args, **kwargs):
+            response, content = request(*args, **kwargs)
+            instrumentation.count_request('googledrive', len(content or b''))
+            return response, content
+        http.request = counted_request
+        if _discovery is None:
+            uri = config.get('GOOGLE_DRIVE_DISCOVERY_URL', DISCOVERY_URI).format(api='drive', apiVersion='v3')
+            response, content = http.request(uri)
+            if response.status >= 400:
+                raise errors.HttpError(response, content, uri=uri)
+            _discovery = json.loads(content.decode('utf-8'))
+    _local.service = build_from_document(_discovery, http=http)
+    return _local.service
+
 def verify_access():
     if os.path.exists(config.get('GOOGLE_DRIVE_CREDENTIALS_FILENAME')):
         # Setup the Drive v3 API
@@ -37,49 +84,153 @@ def verify_access():
 
 def upload(batch, keep_last_n_folders=30):
     parent_folder_id = config.get('GOOGLE_DRIVE_FOLDER_ID')
+    if config.get('GOOGLE_DRIVE_BATCH_CLEANUP', False):
+        # Day folders are tracked in a local manifest instead of listing the parent folder
+        manifest_path = config.get('GOOGLE_DRIVE_MANIFEST_FILE', 'google_drive_folders.json')
+        manifest = _folders_manifest(manifest_path, parent_folder_id, folder_name_regex=r"^\d{8}$")
+        if manifest is None:
+            # The day folders are unknown, upload without cleaning up
+            _upload_batch(_get_or_create_today_folder_id(parent_folder_id), batch)
+            return
+        folder_id = _get_or_create_today_folder_id(parent_folder_id, manifest=manifest)
+        _save_manifest(manifest_path, manifest)
+        _upload_batch(folder_id, batch)
+        _batch_keep_only_last_n_folders(manifest, keep_last_n_folders)
+        _save_manifest(manifest_path, manifest)
+        return
     folder_id = _get_or_create_today_folder_id(parent_folder_id)
     _upload_batch(folder_id, batch)
-    _keep_only_last_n_folders(parent_folder_id, keep_last_n_folders, folder_name_regex="^\d{8}$")
+    _keep_only_last_n_folders(parent_folder_id, keep_last_n_folders, folder_name_regex=r"^\d{8}$")
 
 
-def _get_or_create_today_folder_id(parent_folder_id):
+def _get_or_create_today_folder_id(parent_folder_id, manifest=None):
     now = datetime.utcnow()
     folder_name = "{:04}{:02}{:02}".format(now.year, now.month, now.day)
+    if manifest is not None:
+        for folder_id, name in manifest['folders'].items():
+            if name == folder_name:
+                return folder_id
+        folder_id = _true_mkdir(parent_folder_id, folder_name)
+        if folder_id is not None:
+            manifest['folders'][folder_id] = folder_name
+        else:
+            logger.error("Failed to create folder in Google Drive Team")
+        return folder_id
     folder_id = _mkdir(parent_folder_id, folder_name, avoid_duplicate_name=True)
     return folder_id
 
-def _upload_batch(parent_folder_id, batch):
-    for name, bibcodes in batch.items():
-        fd, path = tempfile.mkstemp(suffix=".txt")
-        try:
+def _load_manifest(path):
+    if not path or not os.path.exists(path):
+        return None
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except:
+        logger.exception("Ignoring unreadable Google Drive manifest '%s'", path)
+        return None
+
+def _save_manifest(path, manifest):
+    try:
+        tmp_path = path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, path)
+    except:
+        logger.exception("Unable to save Google Drive manifest '%s'", path)
+
+def _manifest_listed(manifest):
+    """When the folders of manifest were listed, None if unknown (no manifest, or older or partial)"""
+    try:
+        return datetime.strptime(manifest['listed'], "%Y-%m-%dT%H:%M:%S")
+    except (KeyError, TypeError, ValueError):
+        return None
+
+def _folders_manifest(path, parent_folder_id, folder_name_regex=r"^\d{8}$"):
+    """
+    Manifest of the day folders under parent_folder_id ({'folders': {id: name}, ...}), the parent
+    folder is only listed when there is no (complete) manifest yet, when it does not tell when it
+    was listed, or every GOOGLE_DRIVE_MANIFEST_RELIST_DAYS
+    (to pick up folders created or removed by other means). If that listing fails, the previous
+    manifest is kept until the next run, or None is returned if there is none.
+    """
+    manifest = _load_manifest(path)
+    if not isinstance(manifest, dict) or manifest.get('parent_folder_id') != parent_folder_id or not isinstance(manifest.get('folders'), dict):
+        # No manifest, one of another parent folder, or a partial one
+        manifest = None
+    now = datetime.utcnow()
+    relist_days = config.get('GOOGLE_DRIVE_MANIFEST_RELIST_DAYS', 30)
+    listed = _manifest_listed(manifest)
+    if listed is not None and (not relist_days or listed > now - tsdelta(days=relist_days)):
+        return manifest
+    try:
+        existing_folders = _ls(parent_folder_id, mimetype="application/vnd.google-apps.folder", order_by="modifiedTime desc", raise_errors=True)
+    except:
+        # Already logged by _ls(), a partial listing would make the retention forget folders
+        return manifest
+    folders = {f.get('id'): f.get('name') for f in existing_folders if not folder_name_regex or re.match(folder_name_regex, f.get('name'))}
+    logger.info("Listed %s day folders in Google Team Drive folder '%s'", len(folders), parent_folder_id)
+    return {'parent_folder_id': parent_folder_id, 'listed': now.strftime("%Y-%m-%dT%H:%M:%S"), 'folders': folders}
+
+def _upload_file(parent_folder_id, name, bibcodes):
+    fd, path = tempfile.mkstemp(suffix=".txt")
+    try:
+        with instrumentation.timed('googledrive', 'upload') as fetched:
             with os.fdopen(fd, 'w') as tmp:
                 for bibcode in bibcodes:
                     tmp.write("%s\n" % bibcode)
+                    fetched['rows'] += 1
             _upload(parent_folder_id, name+".txt", path)
-        except:
-            logger.exception("Unable to upload text file '%s' to Google Team Drive", name)
-        finally:
-            os.remove(path)
+    except:
+        logger.exception("Unable to upload text file '%s' to Google Team Drive", name)
+    finally:
+        os.remove(path)
+
+def _upload_stream(parent_folder_id, name, bibcodes, compress=False):
+    try:
+        with instrumentation.timed('googledrive', 'upload') as fetched:
+            fetched['rows'] += len(bibcodes)
+            if compress:
+                _upload_chunks(parent_folder_id, name+".txt.gz", _encode(bibcodes, compress=True), mimetype='application/gzip')
+            else:
+                _upload_chunks(parent_folder_id, name+".txt", _encode(bibcodes))
+    except:
+        logger.exception("Unable to upload text file '%s' to Google Team Drive", name)
 
-def _keep_only_last_n_folders(parent_folder_id, keep_last_n_folders, folder_name_regex="^\d{8}$"):
+def _upload_batch(parent_folder_id, batch):
+    # Files are uploaded concurrently, each worker thread with its own Drive transport
+    streaming = config.get('GOOGLE_DRIVE_STREAMING_UPLOAD', False)
+    compress = config.get('GOOGLE_DRIVE_GZIP', False)
+    with ThreadPoolExecutor(max_workers=config.get('GOOGLE_DRIVE_UPLOAD_WORKERS', 4)) as executor:
+        for name, bibcodes in batch.items():
+            if streaming:
+                executor.submit(instrumentation.propagate(_upload_stream), parent_folder_id, name, bibcodes, compress=compress)
+            else:
+                executor.submit(instrumentation.propagate(_upload_file), parent_folder_id, name, bibcodes)
+
+def _keep_only_last_n_folders(parent_folder_id, keep_last_n_folders, folder_name_regex=r"^\d{8}$"):
     # Keep only last N folders that match format YYYYMMDD (ignore if they do not match)
     existing_folders = _ls(parent_folder_id, mimetype="application/vnd.google-apps.folder", order_by="modifiedTime desc") # oldest files at the end
     n_keep = 0
     for existing_folder in existing_folders:
-        if folder_name_regex and not re.match("^\d{8}$", existing_folder.get('name')):
+        if folder_name_regex and not re.match(folder_name_regex, existing_folder.get('name')):
             continue
         if n_keep > keep_last_n_folders:
             _rm(existing_folder.get('id'))
         else:
             n_keep += 1
 
+def _batch_keep_only_last_n_folders(manifest, keep_last_n_folders):
+    # Same retention as _keep_only_last_n_folders(), the day folders being ordered by name (their date)
+    folders = sorted(manifest['folders'].items(), key=lambda folder: folder[1], reverse=True)
+    expired = [folder_id for folder_id, _ in folders[keep_last_n_folders + 1:]]
+    for folder_id in _rm_batch(expired):
+        manifest['folders'].pop(folder_id, None)
+
 def _upload(parent_folder_id, file_name, file_path, mimetype='text/plain'):
     file_id = None
     if os.path.exists(config.get('GOOGLE_DRIVE_TOKEN_FILENAME')) and os.path.exists(file_path):
-        store = file.Storage(config.get('GOOGLE_DRIVE_TOKEN_FILENAME'))
-        creds = store.get()
         try:
-            drive_service = build('drive', 'v3', http=creds.authorize(Http()), cache_discovery=False)
+            drive_service = _get_service()
             body = {'name': file_name, 'mimeType': mimetype, 'parents': [parent_folder_id]}
             created_file = drive_service.files().create(body=body, media_body=file_path, media_mime_type=mimetype, fields='id, parents', supportsTeamDrives=True).execute()
             file_id = created_file['id']
@@ -93,6 +244,95 @@ def _upload(parent_folder_id, file_name, file_path, mimetype='text/plain'):
     return file_id
 
 
+def _encode(bibcodes, compress=False, lines=10000):
+    """Yield the bibcodes as blocks of newline-terminated lines, gzip-compressed on the fly with compress"""
+    compressor = zlib.compressobj(wbits=31) if compress else None
+    bibcodes = iter(bibcodes)
+    while True:
+        block = "".join("%s\n" % bibcode for bibcode in islice(bibcodes, lines)).encode('utf-8')
+        if not block:
+            break
+        yield compressor.compress(block) if compressor else block
+    if compressor:
+        yield compressor.flush()
+
+
+class _StreamUpload(MediaUpload):
+    """
+    Resumable upload of bytes produced on the fly, without knowing the size in advance
+
+    Only the chunks not yet acknowledged by Drive and a read-ahead of about one chunk are kept in
+    memory. The read-ahead makes the total size known before the last chunk is sent, as the
+    client only closes an upload of unknown size with a short chunk.
+    """
+
+    def __init__(self, blocks, mimetype, chunksize):
+        self._blocks = iter(blocks)
+        self._mimetype = mimetype
+        self._chunksize = chunksize
+        self._buffer = bytearray()
+        # Position of the first buffered byte in the stream
+        self._offset = 0
+        self._size = None
+        self._fill(chunksize + 1)
+
+    def _fill(self, end):
+        """Buffer the stream up to position end (or its end)"""
+        while self._size is None and self._offset + len(self._buffer) < end:
+            block = next(self._blocks, None)
+            if block is None:
+                self._size = self._offset + len(self._buffer)
+            else:
+                self._buffer.extend(block)
+
+    def chunksize(self):
+        return self._chunksize
+
+    def mimetype(self):
+        return self._mimetype
+
+    def size(self):
+        return self._size
+
+    def resumable(self):
+        return True
+
+    def has_stream(self):
+        return False
+
+    def getbytes(self, begin, length):
+        # Bytes before begin have been acknowledged by Drive
+        del self._buffer[:begin - self._offset]
+        self._offset = begin
+        self._fill(begin + 2 * length + 1)
+        return bytes(self._buffer[:length])
+
+
+def _upload_chunks(parent_folder_id, file_name, blocks, mimetype='text/plain'):
+    """Upload the blocks of bytes as a file with a resumable upload, GOOGLE_DRIVE_UPLOAD_CHUNK_SIZE bytes per request"""
+    file_id = None
+    if os.path.exists(config.get('GOOGLE_DRIVE_TOKEN_FILENAME')):
+        drive_service = _get_service()
+        body = {'name': file_name, 'mimeType': mimetype, 'parents': [parent_folder_id]}
+        media = _StreamUpload(blocks, mimetype, config.get('GOOGLE_DRIVE_UPLOAD_CHUNK_SIZE', 5 * 1024 * 1024))
+        if media.size() == 0:
+            # An empty resumable upload cannot be expressed with a byte range
+            media = MediaIoBaseUpload(io.BytesIO(b''), mimetype)
+            created_file = drive_service.files().create(body=body, media_body=media, fields='id, parents', supportsTeamDrives=True).execute()
+        else:
+            request = drive_service.files().create(body=body, media_body=media, fields='id, parents', supportsTeamDrives=True)
+            created_file = None
+            while created_file is None:
+                _, created_file = request.next_chunk()
+        file_id = created_file['id']
+        file_url = "https://drive.google.com/file/d/{}".format(file_id)
+        folder_url = "https://drive.google.com/drive/u/1/folders/{}".format(parent_folder_id)
+        logger.debug("File '%s' uploaded to '%s' in folder '%s", file_name, file_url, folder_url)
+    else:
+        logger.error("File '%s' failed to be uploaded to Google Team Drive", file_name)
+    return file_id
+
+
 def _mkdir(parent_folder_id, folder_name, avoid_duplicate_name=False):
     folder_id = None
     if avoid_duplicate_name:
@@ -115,17 +355,15 @@ def _mkdir(parent_folder_id, folder_name, avoid_duplicate_name=False):
 def _true_mkdir(parent_folder_id, folder_name):
     folder_id = None
     if os.path.exists(config.get('GOOGLE_DRIVE_TOKEN_FILENAME')):
-        store = file.Storage(config.get('GOOGLE_DRIVE_TOKEN_FILENAME'))
-        creds = store.get()
         try:
-            drive_service = build('drive', 'v3', http=creds.authorize(Http()), cache_discovery=False)
+            drive_service = _get_service()
             folder_id = config.get('GOOGLE_DRIVE_FOLDER_ID')
             file_metadata = {
                 'name': folder_name,
                 'mimeType': 'application/vnd.google-apps.folder',
                 'parents': [folder_id]
             }
-            folder_id = drive_service.files().create(body=file_metadata, fields='id', supportsTeamDrives=True).execute()
+            folder_id = drive_service.files().create(body=file_metadata, fields='id', supportsTeamDrives=True).execute().get('id')
         except:
             logger.exception("Failed to create folder '%s' in Google Team Drive", folder_name)
     else:
@@ -133,7 +371,7 @@ def _true_mkdir(parent_folder_id, folder_name):
     return folder_id
 
 
-def _ls(folder_id, older_than=None, mimetype=None, order_by="modifiedTime desc"):
+def _ls(folder_id, older_than=None, mimetype=None, order_by="modifiedTime desc", raise_errors=False):
     """
     Retrieve a list of File resources.
 
@@ -141,14 +379,13 @@ def _ls(folder_id, older_than=None, mimetype=None, order_by="modifiedTime desc")
 
     :param service: Google Drive API service instance
     :param folder_id: Google Drive reference to the folder to be queried (cleaned)
+    :param raise_errors: propagate listing errors instead of returning what was listed so far
     :return a list of File resources
     """
     result = []
     if os.path.exists(config.get('GOOGLE_DRIVE_TOKEN_FILENAME')):
-        store = file.Storage(config.get('GOOGLE_DRIVE_TOKEN_FILENAME'))
-        creds = store.get()
         try:
-            drive_service = build('drive', 'v3', http=creds.authorize(Http()), cache_discovery=False)
+            drive_service = _get_service()
             params = {
                 "q": "'" + folder_id + "' in parents and trashed=false",
                 "orderBy": order_by,
@@ -175,12 +412,18 @@ def _ls(folder_id, older_than=None, mimetype=None, order_by="modifiedTime desc")
                     if not page_token:
                         break
                 except errors.HttpError as error:
+                    if raise_errors:
+                        raise
                     print('An error occurred: %s' % error)
                     break
         except:
             logger.exception("Failed to list content from '%s' in Google Team Drive", folder_id)
+            if raise_errors:
+                raise
     else:
         logger.error("Failed to list content from '%s' in Google Team Drive", folder_id)
+        if raise_errors:
+            raise FileNotFoundError(config.get('GOOGLE_DRIVE_TOKEN_FILENAME'))
     return result
 
 
@@ -189,13 +432,41 @@ def _rm(file_or_directory_id):
     Delete a file or directory from the Google Drive
     """
     if os.path.exists(config.get('GOOGLE_DRIVE_TOKEN_FILENAME')):
-        store = file.Storage(config.get('GOOGLE_DRIVE_TOKEN_FILENAME'))
-        creds = store.get()
         try:
-            drive_service = build('drive', 'v3', http=creds.authorize(Http()), cache_discovery=False)
+            drive_service = _get_service()
             drive_service.files().delete(fileId=file_or_directory_id, supportsAllDrives=True).execute()
         except:
             logger.exception("File/directory '%s' failed to be deleted from Google Team Drive", file_or_directory_id)
     else:
         logger.error("File/directory '%s' failed to be deleted from Google Team Drive", file_or_directory_id)
 
+
+
+def _rm_batch(file_or_directory_ids, batch_size=100):
+    """
+    Delete files or directories with batch requests (Drive accepts up to 100 calls per batch),
+    returns the ids that no longer exist
+    """
+    deleted = []
+    if not file_or_directory_ids:
+        return deleted
+    if not os.path.exists(config.get('GOOGLE_DRIVE_TOKEN_FILENAME')):
+        logger.error("Files/directories '%s' failed to be deleted from Google Team Drive", "', '".join(file_or_directory_ids))
+        return deleted
+
+    def callback(request_id, response, exception):
+        if exception is None or (isinstance(exception, errors.HttpError) and exception.resp.status == 404):
+            deleted.append(request_id)
+        else:
+            logger.error("File/directory '%s' failed to be deleted from Google Team Drive: %s", request_id, exception)
+
+    try:
+        drive_service = _get_service()
+        for i in range(0, len(file_or_directory_ids), batch_size):
+            batch = drive_service.new_batch_http_request(callback=callback)
+            for file_or_directory_id in file_or_directory_ids[i:i+batch_size]:
+                batch.add(drive_service.files().delete(fileId=file_or_directory_id, supportsAllDrives=True), request_id=file_or_directory_id)
+            batch.execute()
+    except:
+        logger.exception("Files/directories failed to be deleted from Google Team Drive")
+    return deleted
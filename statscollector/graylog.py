@@ -1,8 +1,14 @@
+import os
+import json
+import calendar
+import requests
 from urllib.parse import urljoin
-from datetime import datetime
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
 from dateutil.parser import parse as tsparse
 from dateutil.relativedelta import relativedelta as tsdelta
 from grapi.grapi import Grapi
+from . import instrumentation
 from .setup import config, logger
 
 
@@ -22,13 +28,44 @@ def _make_graylog_query (query, from_ts, until_ts, offset=0, limit=1000, fields=
         "sort":   sort
         }
 
+class _SessionApi:
+    """
+    Drop-in replacement for Grapi that sends the searches through one pooled keep-alive
+    session (safe to share between threads) with a timeout per query
+    """
+
+    def __init__(self, url, token, timeout=30, pool_size=10):
+        self.url = url
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.auth = (token, 'token')
+        self.session.headers.update({'Accept': 'application/json'})
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def send(self, method, **params):
+        return self.session.request(method, self.url, params=params, timeout=self.timeout)
+
+_apis = {}
+
+def _get_api(api_url, workers):
+    """Api for api_url, kept between runs (e.g. in daemon mode) so its connections are reused"""
+    if api_url not in _apis:
+        if workers > 1:
+            _apis[api_url] = _SessionApi(api_url, config.get('GRAYLOG_TOKEN'), timeout=config.get('GRAYLOG_TIMEOUT', 30), pool_size=workers)
+        else:
+            _apis[api_url] = Grapi(api_url, config.get('GRAYLOG_TOKEN'))
+    return _apis[api_url]
+
 def _myads_emails(api, start, end):
     results = {}
     fields = ",".join(["timestamp", "namespace_name", "container_name", "message"])
     query = config.get('GRAYLOG_MYADS_QUERY')
-    r = api.send("get", **_make_graylog_query(query, start, end, limit=1, fields=fields))
-    r.raise_for_status()
-    j = r.json()
+    with instrumentation.timed('graylog', 'myads_pipeline_emails'):
+        r = instrumentation.counted('graylog', api.send("get", **_make_graylog_query(query, start, end, limit=1, fields=fields)))
+        r.raise_for_status()
+        j = r.json()
     results['myads_pipeline_emails'] = j.get('total_results')
     return results
 
@@ -36,27 +73,163 @@ def _container(api, start, end, container_name):
     results = {}
     fields = ",".join(["timestamp", "namespace_name", "container_name", "message"])
     query = config.get('GRAYLOG_CONTAINER_QUERY', '').format(container_name)
-    r = api.send("get", **_make_graylog_query(query, start, end, limit=1, fields=fields))
-    r.raise_for_status()
-    j = r.json()
+    with instrumentation.timed('graylog', container_name):
+        r = instrumentation.counted('graylog', api.send("get", **_make_graylog_query(query, start, end, limit=1, fields=fields)))
+        r.raise_for_status()
+        j = r.json()
     results[container_name] = j.get('total_results')
     return results
 
+def _containers(api, start, end, container_names):
+    """
+    Count the logs of all the containers with a single terms aggregation on container_name
+    (containers without logs are absent from the terms and counted as 0)
+    """
+    query = config.get('GRAYLOG_CONTAINERS_TERMS_QUERY', '').format(" OR ".join(container_names))
+    with instrumentation.timed('graylog', 'containers'):
+        r = instrumentation.counted('graylog', api.send("get", query=query, field="container_name", size=len(container_names), **{"from": start, "to": end}))
+        r.raise_for_status()
+        j = r.json()
+    terms = j.get('terms', {})
+    return {container_name: terms.get(container_name, 0) for container_name in container_names}
+
+def _stats_concurrently(api, start, end, container_names, workers):
+    """Send all the searches at once, the total latency being close to the slowest one"""
+    queries = [("Unable to retrieve myads emails logs from graylog", _myads_emails, ())]
+    for container_name in container_names:
+        queries.append(("Unable to retrieve '{}' logs from graylog".format(container_name), _container, (container_name,)))
+
+    results = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [(message, executor.submit(instrumentation.propagate(query), api, start, end, *args)) for message, query, args in queries]
+        # Collect in submission order so that the results keep the same order as the sequential path
+        for message, future in futures:
+            try:
+                results.update(future.result())
+            except:
+                logger.exception(message)
+    return results
+
+def _histogram(api, query, start, end, name='histogram'):
+    """Per-minute counts of query as {minute start in epoch seconds: count}, empty minutes are absent"""
+    with instrumentation.timed('graylog', name):
+        r = instrumentation.counted('graylog', api.send("get", query=query, interval="minute", **{"from": start, "to": end}))
+        r.raise_for_status()
+        j = r.json()
+    return {int(k): v for k, v in j.get('results', {}).items()}
+
+def _load_bucket_cache(path):
+    try:
+        with open(path, "r") as f:
+            return {key: {int(minute): count for minute, count in buckets.items()} for key, buckets in json.load(f).items()}
+    except FileNotFoundError:
+        return {}
+    except:
+        logger.exception("Ignoring unreadable graylog bucket cache '%s'", path)
+        return {}
+
+def _save_bucket_cache(path, cache):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(cache, f)
+    os.replace(tmp_path, path)
+
+def _format_ts(epoch):
+    return datetime.utcfromtimestamp(epoch).isoformat(sep=' ', timespec='milliseconds')
+
+def _bucketed_stats(api, workers):
+    """
+    Hourly counts assembled from cached one-minute buckets, Graylog is only asked (with one
+    histogram per query) for the minutes completed since the previous run. The hour covers the
+    last completed GRAYLOG_BUCKET_MINUTES buckets, after GRAYLOG_BUCKET_DELAY minutes of
+    indexing delay, instead of the trailing hour up to now.
+    """
+    bucket_minutes = config.get('GRAYLOG_BUCKET_MINUTES', 1)
+    cache_path = config.get('GRAYLOG_BUCKET_CACHE_FILE', 'graylog_buckets.json')
+    now = datetime.utcnow() - timedelta(minutes=config.get('GRAYLOG_BUCKET_DELAY', 1))
+    end = now.replace(second=0, microsecond=0)
+    end -= timedelta(minutes=end.minute % bucket_minutes)
+    end = calendar.timegm(end.utctimetuple())
+    window = list(range(end - 3600, end, 60))
+
+    queries = {'myads_pipeline_emails': config.get('GRAYLOG_MYADS_QUERY')}
+    for container_name in config.get('GRAYLOG_CONTAINER_NAMES', []):
+        queries[container_name] = config.get('GRAYLOG_CONTAINER_QUERY', '').format(container_name)
+
+    cache = _load_bucket_cache(cache_path)
+    missing = {}
+    for key in queries:
+        minutes = [minute for minute in window if minute not in cache.get(key, {})]
+        if minutes:
+            missing[key] = (minutes[0], minutes[-1] + 60)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        histogram = instrumentation.propagate(_histogram)
+        futures = {key: executor.submit(histogram, api, queries[key], _format_ts(first), _format_ts(last - 0.001), name=key) for key, (first, last) in missing.items()}
+        for key, future in futures.items():
+            first, last = missing[key]
+            try:
+                counts = future.result()
+            except:
+                logger.exception("Unable to retrieve '%s' logs from graylog", key)
+                continue
+            buckets = cache.setdefault(key, {})
+            for minute in range(first, last, 60):
+                buckets[minute] = counts.get(minute, 0)
+
+    results = {}
+    for key in queries:
+        buckets = cache.get(key, {})
+        if all(minute in buckets for minute in window):
+            results[key] = sum(buckets[minute] for minute in window)
+
+    # Evict the buckets that fell out of the window more than GRAYLOG_BUCKET_TTL minutes ago
+    oldest = window[0] - 60 * config.get('GRAYLOG_BUCKET_TTL', 60)
+    cache = {key: {minute: count for minute, count in buckets.items() if minute >= oldest} for key, buckets in cache.items() if key in queries}
+    try:
+        _save_bucket_cache(cache_path, cache)
+    except:
+        logger.exception("Unable to save graylog bucket cache '%s'", cache_path)
+    return results
+
 def stats():
     url = urljoin(config.get('GRAYLOG_URL'), "api/search/universal/absolute")
-    api = Grapi(url, config.get('GRAYLOG_TOKEN'))
+    terms_url = urljoin(config.get('GRAYLOG_URL'), "api/search/universal/absolute/terms")
     now = datetime.utcnow()
     before = now - tsdelta(hours=1)
     start = before.isoformat(sep=' ', timespec='milliseconds')
     end = (now + tsdelta(minutes=1)).isoformat(sep=' ', timespec='milliseconds')
 
+    workers = config.get('GRAYLOG_WORKERS', 1)
+    api_class = lambda api_url: _get_api(api_url, workers)
+
+    if config.get('GRAYLOG_BUCKETED', False):
+        histogram_url = urljoin(config.get('GRAYLOG_URL'), "api/search/universal/absolute/histogram")
+        return _bucketed_stats(api_class(histogram_url), workers)
+
+    container_names = list(config.get('GRAYLOG_CONTAINER_NAMES', []))
+    containers_results = {}
+    if config.get('GRAYLOG_AGGREGATE_CONTAINERS', False) and container_names:
+        try:
+            containers_results = _containers(api_class(terms_url), start, end, container_names)
+            container_names = []
+        except:
+            logger.exception("Unable to aggregate container logs from graylog, falling back to one search per container")
+
+    api = api_class(url)
+    if workers > 1:
+        results = _stats_concurrently(api, start, end, container_names, workers)
+        results.update(containers_results)
+        return results
+
     results = {}
     try:
         results.update(_myads_emails(api, start, end))
     except:
         logger.exception("Unable to retrieve myads emails logs from graylog")
 
-    for container_name in config.get('GRAYLOG_CONTAINER_NAMES', []):
+    results.update(containers_results)
+    for container_name in container_names:
         try:
             results.update(_container(api, start, end, container_name))
         except:
@@ -0,0 +1,93 @@
+import time
+import resource
+import threading
+import contextvars
+from contextlib import contextmanager
+
+# Statistics of the collector run in progress (see collector_run()), None outside of a run
+_run = contextvars.ContextVar('collector_run', default=None)
+_lock = threading.Lock()
+
+
+@contextmanager
+def collector_run():
+    """
+    Instrument a collector run, the yielded dict is filled with its wall time, success (1 unless
+    an exception escapes or the caller sets it to 0, e.g. when some figures could not be collected),
+    the peak RSS of the whole process so far, and per source the HTTP requests and bytes received
+    plus the seconds, calls, errors and rows of every sub-query (see timed() and counted())
+
+    The peak RSS is not the memory used by the run: it never decreases, and it includes earlier
+    runs and the collectors running concurrently in the same process (--parallel, --daemon).
+    """
+    results = {}
+    token = _run.set(results)
+    start = time.monotonic()
+    try:
+        yield results
+        results.setdefault('success', 1)
+    finally:
+        _run.reset(token)
+        results.setdefault('success', 0)
+        results['seconds'] = round(time.monotonic() - start, 3)
+        results['process_peak_rss_bytes'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def propagate(function):
+    """
+    Wrap function so that it is attributed to the current collector run when called from pool
+    threads (ThreadPoolExecutor does not carry the context over), each call gets its own copy
+    """
+    context = contextvars.copy_context()
+    return lambda *args, **kwargs: context.copy().run(function, *args, **kwargs)
+
+
+@contextmanager
+def timed(source, query):
+    """
+    Time a sub-query of source (e.g. 'solr', 'update'), the yielded dict counts the rows it
+    fetched; exceptions are counted as errors and propagated
+    """
+    fetched = {'rows': 0}
+    results = _run.get()
+    start = time.monotonic()
+    failed = False
+    try:
+        yield fetched
+    except Exception:
+        failed = True
+        raise
+    finally:
+        if results is not None:
+            with _lock:
+                query_results = results.setdefault(source, {}).setdefault(query, {'seconds': 0., 'calls': 0, 'errors': 0, 'rows': 0})
+                query_results['seconds'] = round(query_results['seconds'] + time.monotonic() - start, 3)
+                query_results['calls'] += 1
+                query_results['errors'] += int(failed)
+                query_results['rows'] += fetched['rows']
+
+
+def errors(source):
+    """Sub-queries of source that failed so far in the current collector run (0 outside of a run)"""
+    results = _run.get()
+    if results is None:
+        return 0
+    with _lock:
+        return sum(query['errors'] for query in results.get(source, {}).values() if isinstance(query, dict))
+
+
+def count_request(source, size=0):
+    """Count an HTTP request of source and the size in bytes of its response"""
+    results = _run.get()
+    if results is not None:
+        with _lock:
+            source_results = results.setdefault(source, {})
+            source_results['requests'] = source_results.get('requests', 0) + 1
+            source_results['bytes'] = source_results.get('bytes', 0) + size
+
+
+def counted(source, response):
+    """Count a requests response (see count_request()) and return it"""
+    if _run.get() is not None:
+        count_request(source, len(response.content))
+    return response
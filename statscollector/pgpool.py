@@ -0,0 +1,111 @@
+import os
+import threading
+import psycopg2
+from contextlib import contextmanager
+from psycopg2.pool import ThreadedConnectionPool
+from .setup import config, logger
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+class _Pool:
+    """ThreadedConnectionPool that waits for a free connection instead of raising when exhausted"""
+
+    def __init__(self, host, port):
+        maxconn = config.get('POSTGRES_POOL_MAX_CONNECTIONS', 8)
+        self.slots = threading.BoundedSemaphore(maxconn)
+        self.pool = ThreadedConnectionPool(0, maxconn,
+                                           host=host,
+                                           port=port,
+                                           database=config.get('POSTGRES_MASTER_PIPELINE_DB'),
+                                           user=config.get('POSTGRES_USER'),
+                                           password=config.get('POSTGRES_PASSWORD'),
+                                           options=_options())
+        # Connections are opened on demand, but psycopg2 only keeps minconn of them once
+        # returned, the others being closed
+        self.pool.minconn = maxconn
+
+    def getconn(self):
+        self.slots.acquire()
+        try:
+            return self.pool.getconn()
+        except:
+            self.slots.release()
+            raise
+
+    def putconn(self, connection, close=False):
+        try:
+            self.pool.putconn(connection, close=close)
+        finally:
+            self.slots.release()
+
+    def closeall(self):
+        self.pool.closeall()
+
+
+def _options():
+    """Server options of every pooled connection (PGOPTIONS from the environment is kept)"""
+    options = [os.environ.get('PGOPTIONS', '')]
+    statement_timeout = config.get('POSTGRES_STATEMENT_TIMEOUT', None)
+    if statement_timeout:
+        options.append('-c statement_timeout={:d}'.format(int(statement_timeout * 1000)))
+    return " ".join(option for option in options if option)
+
+
+def _get_pool(replica):
+    key = 'replica' if replica and config.get('POSTGRES_REPLICA_HOST') else 'primary'
+    with _pools_lock:
+        if key not in _pools:
+            if key == 'replica':
+                host = config.get('POSTGRES_REPLICA_HOST')
+                port = config.get('POSTGRES_REPLICA_PORT', config.get('POSTGRES_PORT'))
+            else:
+                host = config.get('POSTGRES_HOST')
+                port = config.get('POSTGRES_PORT')
+            logger.debug("Creating %s postgres connection pool for %s:%s", key, host, port)
+            _pools[key] = _Pool(host, port)
+        return _pools[key]
+
+
+@contextmanager
+def connection(readonly=True, replica=True, statement_timeout=None):
+    """
+    Borrow a connection from the shared pool
+
+    Read-only connections are routed to POSTGRES_REPLICA_HOST when it is configured, and run
+    their queries in read-only transactions. A statement_timeout in seconds (0: no limit)
+    replaces POSTGRES_STATEMENT_TIMEOUT while the connection is borrowed. The transaction is
+    rolled back when the connection is returned, and connections left broken are discarded
+    instead of being reused.
+    """
+    pool = _get_pool(replica and readonly)
+    master_connection = pool.getconn()
+    close = False
+    try:
+        if master_connection.readonly != readonly:
+            master_connection.readonly = readonly
+        if statement_timeout is not None:
+            with master_connection.cursor() as cursor:
+                cursor.execute("SET statement_timeout = %s", (int(statement_timeout * 1000),))
+            master_connection.commit()
+        yield master_connection
+    finally:
+        try:
+            master_connection.rollback()
+            if statement_timeout is not None:
+                # Back to the value of the connection options
+                with master_connection.cursor() as cursor:
+                    cursor.execute("RESET statement_timeout")
+                master_connection.commit()
+        except psycopg2.Error:
+            close = True
+        pool.putconn(master_connection, close=close or bool(master_connection.closed))
+
+
+def closeall():
+    """Close every pooled connection (e.g. before forking or exiting)"""
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.closeall()
+        _pools.clear()
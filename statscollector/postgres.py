@@ -1,4 +1,8 @@
-import psycopg2
+import os
+import json
+from datetime import datetime, timedelta
+from . import pgpool
+from . import instrumentation
 from .setup import config, logger
 
 INTERVAL = '1 HOURS'
@@ -7,6 +11,15 @@ BIBCODES = """
 SELECT  bibcode FROM records WHERE bib_data IS NOT NULL;
 """
 
+BIBCODES_SINCE = """
+SELECT  bibcode FROM records WHERE bib_data IS NOT NULL AND bib_data_updated > %(since)s;
+"""
+
+# Byte-wise collation so that the order matches python string comparison
+SORTED_BIBCODES = """
+SELECT  bibcode FROM records WHERE bib_data IS NOT NULL ORDER BY bibcode COLLATE "C";
+"""
+
 COUNTS = """
 SELECT  count(*) AS total,
         count(bib_data) AS bib_data,
@@ -72,87 +85,189 @@ SELECT * FROM total, solr, metrics, datalinks;
 
 CREATED = "SELECT count(*) AS count FROM records WHERE created BETWEEN NOW() - INTERVAL '{0}' AND NOW();".format(INTERVAL)
 
-def stats():
-    host = config.get('POSTGRES_HOST')
-    port = config.get('POSTGRES_PORT')
-    user = config.get('POSTGRES_USER')
-    password = config.get('POSTGRES_PASSWORD')
-    master_pipeline_db = config.get('POSTGRES_MASTER_PIPELINE_DB')
+# Results key and records column for every figure computed by the single-pass STATS query
+UPDATED_COLUMNS = (
+    ('total', 'updated'),
+    ('bib_data', 'bib_data_updated'),
+    ('nonbib_data', 'nonbib_data_updated'),
+    ('metrics', 'metrics_updated'),
+    ('orcid_claims', 'orcid_claims_updated'),
+    ('augments', 'augments_updated'),
+    ('fulltext', 'fulltext_updated'),
+)
+PROCESSED_COLUMNS = (
+    ('total', 'processed'),
+    ('solr', 'solr_processed'),
+    ('metrics', 'metrics_processed'),
+    ('datalinks', 'datalinks_processed'),
+)
+REGISTERED_COLUMNS = (
+    ('total', '*'),
+    ('bib_data', 'bib_data'),
+    ('nonbib_data', 'nonbib_data'),
+    ('metrics', 'metrics'),
+    ('orcid_claims', 'orcid_claims'),
+    ('augments', 'augments'),
+    ('fulltext', 'fulltext'),
+)
 
-    results = {}
-    master_connection = None
+WINDOWED_COLUMNS = ['created'] + [column for _, column in UPDATED_COLUMNS] + [column for _, column in PROCESSED_COLUMNS]
+
+def _in_interval(column):
+    return "count(*) FILTER (WHERE {0} BETWEEN since AND until)".format(column)
+
+# Same figures as CREATED, UPDATED, PROCESSED and COUNTS computed in one scan of records
+STATS = """
+SELECT  {0}
+FROM records, (SELECT NOW() - INTERVAL '{1}' AS since, NOW() AS until) AS bounds;
+""".format(",\n        ".join(
+    [_in_interval(column) for column in WINDOWED_COLUMNS] +
+    ["count({0})".format(column) for _, column in REGISTERED_COLUMNS]
+), INTERVAL)
+
+# Only the created/updated/processed figures, restricted to the rows in the interval so that
+# the timestamp indexes can be used instead of a full scan
+WINDOWED_STATS = """
+SELECT  {0}
+FROM records, (SELECT NOW() - INTERVAL '{1}' AS since, NOW() AS until) AS bounds
+WHERE {2};
+""".format(",\n        ".join(_in_interval(column) for column in WINDOWED_COLUMNS),
+           INTERVAL,
+           "\n   OR ".join("{0} BETWEEN since AND until".format(column) for column in WINDOWED_COLUMNS))
+
+# Registered figures of the records created since the last checkpoint (see _registered())
+REGISTERED_DELTA = """
+SELECT  {0}
+FROM records
+WHERE created > %(since)s AND created <= %(until)s;
+""".format(",\n        ".join("count({0})".format(column) for _, column in REGISTERED_COLUMNS))
+
+def _stats_results(row):
+    """Map a STATS (or WINDOWED_STATS) row to the results dict expected by prometheus.push"""
+    row = list(row)
+    results = {'created': row.pop(0)}
+    for name, columns in (('updated', UPDATED_COLUMNS), ('processed', PROCESSED_COLUMNS), ('registered', REGISTERED_COLUMNS)):
+        if row:
+            results[name] = {key: row.pop(0) for key, _ in columns}
+    return results
+
+def _load_checkpoint(path):
+    try:
+        with open(path, "r") as f:
+            checkpoint = json.load(f)
+        checkpoint['timestamp'] = datetime.fromisoformat(checkpoint['timestamp'])
+        checkpoint['recounted'] = datetime.fromisoformat(checkpoint['recounted'])
+    except FileNotFoundError:
+        return None
+    except:
+        logger.exception("Ignoring unreadable postgres checkpoint '%s'", path)
+        return None
+    return checkpoint
+
+def _save_checkpoint(path, checkpoint):
     try:
-        master_connection = psycopg2.connect(host=host,
-                                             port=port,
-                                             database=master_pipeline_db,
-                                             user=user,
-                                             password=password)
-        with master_connection.cursor() as master_cursor:
-            master_cursor.execute(CREATED)
-            created, = master_cursor.fetchone()
-            results['created'] = created
-            master_cursor.execute(UPDATED)
-            total, bib_data, nonbib_data, metrics, orcid_claims, augments, fulltext = master_cursor.fetchone()
-            results['updated'] = {
-                'total': total,
-                'bib_data': bib_data,
-                'nonbib_data': nonbib_data,
-                'metrics': metrics,
-                'orcid_claims': orcid_claims,
-                'augments': augments,
-                'fulltext': fulltext
-            }
-            master_cursor.execute(PROCESSED)
-            total, solr, metrics, datalinks = master_cursor.fetchone()
-            results['processed'] = {
-                'total': total,
-                'solr': solr,
-                'metrics': metrics,
-                'datalinks': datalinks
-            }
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({
+                'timestamp': checkpoint['timestamp'].isoformat(),
+                'recounted': checkpoint['recounted'].isoformat(),
+                'registered': checkpoint['registered'],
+            }, f)
+        os.replace(tmp_path, path)
+    except:
+        logger.exception("Unable to save postgres checkpoint '%s'", path)
+
+def _registered(master_cursor, checkpoint_path, recount_interval):
+    """
+    Registered figures advanced from the checkpoint with the records created since then, or fully
+    recounted when there is no checkpoint or the last recount is older than recount_interval hours.
+
+    Every record is only added once, when it is created, with the columns it has at that point.
+    The *_updated timestamps cannot tell a column that became set from one that was updated again,
+    so columns set later on older records, cleared columns and deleted records only show up at the
+    next recount.
+    """
+    master_cursor.execute("SELECT NOW();")
+    now, = master_cursor.fetchone()
+    checkpoint = _load_checkpoint(checkpoint_path)
+    if checkpoint is None or now - checkpoint['recounted'] >= timedelta(hours=recount_interval):
+        with instrumentation.timed('postgres', 'counts'):
             master_cursor.execute(COUNTS)
-            total, bib_data, nonbib_data, metrics, orcid_claims, augments, fulltext = master_cursor.fetchone()
-            results['registered'] = {
-                'total': total,
-                'bib_data': bib_data,
-                'nonbib_data': nonbib_data,
-                'metrics': metrics,
-                'orcid_claims': orcid_claims,
-                'augments': augments,
-                'fulltext': fulltext
-            }
+            registered = {key: value for (key, _), value in zip(REGISTERED_COLUMNS, master_cursor.fetchone())}
+        recounted = now
+    else:
+        with instrumentation.timed('postgres', 'registered_delta'):
+            master_cursor.execute(REGISTERED_DELTA, {'since': checkpoint['timestamp'], 'until': now})
+            registered = {key: checkpoint['registered'].get(key, 0) + value for (key, _), value in zip(REGISTERED_COLUMNS, master_cursor.fetchone())}
+        recounted = checkpoint['recounted']
+    _save_checkpoint(checkpoint_path, {'timestamp': now, 'recounted': recounted, 'registered': registered})
+    return registered
+
+def stats(incremental=None):
+    if incremental is None:
+        incremental = config.get('POSTGRES_INCREMENTAL_REGISTERED', False)
+
+    results = {}
+    try:
+        with pgpool.connection() as master_connection, master_connection.cursor() as master_cursor:
+            if incremental:
+                with instrumentation.timed('postgres', 'windowed_stats'):
+                    master_cursor.execute(WINDOWED_STATS)
+                    results = _stats_results(master_cursor.fetchone())
+                results['registered'] = _registered(master_cursor,
+                                                    config.get('POSTGRES_CHECKPOINT_FILE', 'postgres_checkpoint.json'),
+                                                    config.get('POSTGRES_REGISTERED_RECOUNT_INTERVAL', 24))
+            elif config.get('POSTGRES_SINGLE_SCAN_STATS', False):
+                with instrumentation.timed('postgres', 'stats'):
+                    master_cursor.execute(STATS)
+                    results = _stats_results(master_cursor.fetchone())
+            else:
+                # One query per figure, the windowed ones can use the timestamp indexes
+                row = []
+                for name, query in (('created', CREATED), ('updated', UPDATED), ('processed', PROCESSED), ('counts', COUNTS)):
+                    with instrumentation.timed('postgres', name):
+                        master_cursor.execute(query)
+                        row.extend(master_cursor.fetchone())
+                results = _stats_results(row)
     except:
         logger.exception("Failed retrieving stats from postgres")
         return {}
-    finally:
-        if master_connection is not None:
-            master_connection.close()
     return results
 
-def bibcodes():
-    host = config.get('POSTGRES_HOST')
-    port = config.get('POSTGRES_PORT')
-    user = config.get('POSTGRES_USER')
-    password = config.get('POSTGRES_PASSWORD')
-    master_pipeline_db = config.get('POSTGRES_MASTER_PIPELINE_DB')
+def _stream_bibcodes(query, cursor_name, params=None):
+    """
+    Stream bibcodes through a server-side (named) cursor, fetching POSTGRES_BIBCODES_FETCH_SIZE
+    rows at a time (only the fetches are timed, not the consumer)
+    """
+    fetch_size = config.get('POSTGRES_BIBCODES_FETCH_SIZE', 100000)
+    with pgpool.connection() as master_connection, master_connection.cursor(name=cursor_name) as master_cursor:
+        with instrumentation.timed('postgres', cursor_name):
+            master_cursor.execute(query, params)
+        while True:
+            with instrumentation.timed('postgres', cursor_name) as fetched:
+                rows = master_cursor.fetchmany(fetch_size)
+                fetched['rows'] += len(rows)
+            if not rows:
+                break
+            for bibcode, in rows:
+                yield bibcode
 
-    bibcodes = []
-    master_connection = None
-    try:
-        master_connection = psycopg2.connect(host=host,
-                                             port=port,
-                                             database=master_pipeline_db,
-                                             user=user,
-                                             password=password)
-        with master_connection.cursor() as master_cursor:
-            chunk_size = 100000
-            master_cursor.itersize = chunk_size
-            master_cursor.execute(BIBCODES)
-            bibcodes = [bibcode for (bibcode,) in master_cursor]
-    except:
-        logger.exception("Failed retrieving bibcodes from postgres")
-        return []
-    finally:
-        if master_connection is not None:
-            master_connection.close()
-    return bibcodes
+def bibcodes(since=None):
+    """
+    Stream bibcodes, or only those whose bib_data was updated after since (exceptions are
+    propagated, classic.compare() logs them)
+    """
+    if since is not None:
+        return _stream_bibcodes(BIBCODES_SINCE, 'bibcodes_since', {'since': since})
+    return _stream_bibcodes(BIBCODES, 'bibcodes')
+
+def now():
+    """Current database time"""
+    with pgpool.connection() as master_connection, master_connection.cursor() as master_cursor, instrumentation.timed('postgres', 'now'):
+        master_cursor.execute("SELECT NOW();")
+        now, = master_cursor.fetchone()
+    return now
+
+def sorted_bibcodes():
+    """Stream bibcodes in ascending order (exceptions are propagated)"""
+    return _stream_bibcodes(SORTED_BIBCODES, 'sorted_bibcodes')
@@ -1,14 +1,36 @@
 import os
+import threading
 import requests
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from urllib.parse import urljoin
+from . import instrumentation
 from .setup import config, logger
 
-def _build_url(job, provider, instance):
+_session = None
+_exporter = None
+_registry = {}
+_registry_lock = threading.Lock()
+_exposition = b''
+
+def _get_session():
+    """Pooled keep-alive session shared by all pushes"""
+    global _session
+    if _session is None:
+        _session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=config.get('PROMETHEUS_PUSHGATEWAY_POOL_SIZE', 4))
+        _session.mount('http://', adapter)
+        _session.mount('https://', adapter)
+    return _session
+
+def _build_url(job, provider, instance, label=None):
     """Build URL"""
     base_url = config.get('PROMETHEUS_PUSHGATEWAY_URL')
     endpoint = 'metrics/job/{j}/provider/{p}'.format(j=job, p=provider)
     if instance:
         endpoint += '/instance/{i}'.format(i=instance)
+    if label:
+        # Part of the grouping key, otherwise pushes with different labels replace each other
+        endpoint += '/label/{l}'.format(l=label)
     url = urljoin(base_url, endpoint)
     return url
 
@@ -24,17 +46,43 @@ def _build_data(payload_key, payload_type, payload_description, payload_label, p
     data += '{payload_key}{payload_label} {payload_value}\n'.format(payload_key=payload_key, payload_label=payload_label, payload_value=payload_value)
     return data
 
+def _build_labels(labels):
+    """Build label set, e.g. {key="commits",label="x"}"""
+    labels = ["{k}=\"{v}\"".format(k=k, v=str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in labels.items() if v]
+    if labels:
+        return "{" + ",".join(labels) + "}"
+    return ""
+
+def _build_batch_data(payload_key, payload_type, payload_description, samples):
+    """Build a single data payload with one sample per (labels, value)"""
+    data = '# TYPE {payload_key} {payload_type}\n'.format(payload_key=payload_key, payload_type=payload_type)
+    if payload_description:
+        data += '# HELP {payload_key} {payload_description}\n'.format(payload_key=payload_key, payload_description=payload_description)
+    for labels, payload_value in samples:
+        data += '{payload_key}{payload_labels} {payload_value}\n'.format(payload_key=payload_key, payload_labels=_build_labels(labels), payload_value=payload_value)
+    return data
+
 def _push(job, payload_key, payload_value, provider=config.get('PROMETHEUS_PUSHGATEWAY_PROVIDER'), instance=config.get('PROMETHEUS_PUSHGATEWAY_INSTANCE'), payload_type="untyped", payload_description=None, payload_label=None, simulate=False):
-    url = _build_url(job, provider, instance)
+    url = _build_url(job, provider, instance, label=payload_label)
     data = _build_data(payload_key, payload_type, payload_description, payload_label, payload_value)
     if not simulate:
-        r = requests.post(url, data=data, timeout=30)
+        r = instrumentation.counted('prometheus', _get_session().post(url, data=data, timeout=30))
         #r = requests.delete(url, data=None, timeout=30)
         r.raise_for_status()
     else:
         logger.info("[SIMULATED] Push key '%s', job '%s', instance '%s', provider '%s' and value '%s'", payload_key, job, provider, instance, payload_value)
 
 
+def _push_batch(payload_key, samples, provider=config.get('PROMETHEUS_PUSHGATEWAY_PROVIDER'), instance=config.get('PROMETHEUS_PUSHGATEWAY_INSTANCE'), payload_type="untyped", payload_description=None, payload_label=None, simulate=False):
+    url = _build_url(payload_key, provider, instance, label=payload_label)
+    data = _build_batch_data(payload_key, payload_type, payload_description, samples)
+    if not simulate:
+        r = instrumentation.counted('prometheus', _get_session().post(url, data=data, timeout=30))
+        r.raise_for_status()
+    else:
+        logger.info("[SIMULATED] Push key '%s' with %s samples, instance '%s' and provider '%s'", payload_key, len(samples), instance, provider)
+
+
 def _is_number(string):
     try:
         float(string)
@@ -42,16 +90,78 @@ def _is_number(string):
     except ValueError:
         return False
 
-def push(payload_key, results, prefix=None, simulate=False):
+def _flatten(results, prefix=None):
+    """Yield (job, value) for every numeric leaf of the results dict"""
     if prefix is None:
         prefix = []
     for k, v in results.items():
         if isinstance(v, dict):
-            push(payload_key, v, prefix=prefix+[k], simulate=simulate)
+            yield from _flatten(v, prefix=prefix+[k])
         elif isinstance(v, (int, float)) or (isinstance(v, str) and _is_number(v)):
-            job = "_".join(prefix+[k])
-            payload_value = v
-            try:
-                _push(job, payload_key, payload_value, simulate=simulate)
-            except:
-                logger.exception("Unable to push key '%s', job '%s' and value '%s'", payload_key, job, payload_value)
+            yield "_".join(prefix+[k]), v
+
+class _ExporterHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = _exposition
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug("Exporter: " + format, *args)
+
+def serve(port, address=''):
+    """
+    Serve the collected values at /metrics from a background thread, from then on push()
+    stores the values in the exporter registry instead of sending them to the pushgateway
+    """
+    global _exporter
+    _exporter = ThreadingHTTPServer((address, port), _ExporterHandler)
+    threading.Thread(target=_exporter.serve_forever, name='exporter', daemon=True).start()
+    logger.info("Serving metrics at http://%s:%s/metrics", address or '0.0.0.0', _exporter.server_address[1])
+    return _exporter
+
+def _record(payload_key, samples, label=None):
+    """Replace the samples of payload_key (and label) in the registry and render the exposition text once"""
+    global _exposition
+    with _registry_lock:
+        _registry[(payload_key, label)] = samples
+        groups = {}
+        for (key, _), group_samples in sorted(_registry.items(), key=lambda item: (item[0][0], item[0][1] or '')):
+            groups.setdefault(key, []).extend(group_samples)
+        _exposition = "".join(_build_batch_data(key, "untyped", None, key_samples) for key, key_samples in groups.items()).encode('utf-8')
+
+def push(payload_key, results, prefix=None, simulate=False, batch=None, label=None):
+    """
+    Push every numeric leaf of results to the pushgateway
+
+    With batch enabled (PROMETHEUS_PUSHGATEWAY_BATCH by default), all the leaves are sent in a
+    single request grouped under job=payload_key, and the leaf name that used to be the job is
+    kept in the 'key' label of each sample. An optional label (e.g. the solr core) is added to
+    every sample and to the grouping key. When the exporter is serving (see serve()), the
+    samples replace the previous ones of payload_key in its registry instead.
+    """
+    if _exporter is not None:
+        _record(payload_key, [({'key': job, 'label': label}, payload_value) for job, payload_value in _flatten(results, prefix=prefix)], label=label)
+        return
+    if batch is None:
+        batch = config.get('PROMETHEUS_PUSHGATEWAY_BATCH', False)
+    if batch:
+        samples = [({'key': job, 'label': label}, payload_value) for job, payload_value in _flatten(results, prefix=prefix)]
+        if not samples:
+            return
+        try:
+            _push_batch(payload_key, samples, payload_label=label, simulate=simulate)
+        except:
+            logger.exception("Unable to push key '%s' with %s samples", payload_key, len(samples))
+        return
+    for job, payload_value in _flatten(results, prefix=prefix):
+        try:
+            _push(job, payload_key, payload_value, payload_label=label, simulate=simulate)
+        except:
+            logger.exception("Unable to push key '%s', job '%s' and value '%s'", payload_key, job, payload_value)
@@ -0,0 +1,118 @@
+import time
+import threading
+from .setup import logger
+
+
+class _Job(threading.Thread):
+    """Daemon thread running one collector so a hung source never blocks the process exit"""
+
+    def __init__(self, name, target, slots, lock):
+        super().__init__(name=name, daemon=True)
+        self.target = target
+        self.slots = slots
+        self.lock = lock
+        self.started_at = None
+        self.finished_at = None
+        self.finished = threading.Event()
+        self.abandoned = False
+        self.done = False
+        self.result = None
+        self.error = None
+
+    def run(self):
+        self.slots.acquire()
+        with self.lock:
+            self.started_at = time.monotonic()
+        try:
+            self.result = self.target()
+        except Exception as e:
+            self.error = e
+            logger.exception("Collector '%s' failed", self.name)
+        finally:
+            with self.lock:
+                if not self.abandoned:
+                    self.slots.release()
+                self.done = True
+                self.finished_at = time.monotonic()
+            self.finished.set()
+
+
+def _abandon_if_late(thread, slots, lock, timeout):
+    """Abandon thread if it has been running for more than timeout seconds, returns True if so"""
+    with lock:
+        if timeout and not thread.done and thread.started_at is not None and time.monotonic() - thread.started_at > timeout:
+            # Hand its slot over to queued collectors, the thread itself cannot be killed
+            thread.abandoned = True
+            slots.release()
+            logger.error("Collector '%s' did not finish within %s seconds", thread.name, timeout)
+            return True
+    return False
+
+
+def run(jobs, max_workers=None, timeout=None, poll_interval=0.5):
+    """
+    Run collectors concurrently
+
+    :param jobs: dict mapping a collector name to a callable without arguments
+    :param max_workers: maximum number of collectors running at the same time (all of them if None)
+    :param timeout: seconds a collector is allowed to run before being abandoned (no limit if None)
+    :return: dict mapping each collector name to 'ok', 'failed' or 'timeout'
+    """
+    slots = threading.Semaphore(max(1, max_workers or len(jobs)))
+    lock = threading.Lock()
+
+    threads = [_Job(name, target, slots, lock) for name, target in jobs.items()]
+    for thread in threads:
+        thread.start()
+
+    status = {}
+    pending = list(threads)
+    while pending:
+        for thread in list(pending):
+            if thread.finished.is_set():
+                status[thread.name] = 'failed' if thread.error is not None else 'ok'
+                pending.remove(thread)
+                continue
+            if _abandon_if_late(thread, slots, lock, timeout):
+                status[thread.name] = 'timeout'
+                pending.remove(thread)
+        if pending:
+            pending[0].finished.wait(poll_interval)
+    return status
+
+
+def daemon(jobs, intervals, max_workers=None, timeout=None, poll_interval=1, stop=None):
+    """
+    Run collectors periodically until stop is set
+
+    Every collector starts right away and then every intervals[name] seconds (counted from the
+    start of its previous run). A collector is not started again while its previous run is
+    still going, unless that run was abandoned after timeout seconds.
+
+    :param jobs: dict mapping a collector name to a callable without arguments
+    :param intervals: dict mapping a collector name to its interval in seconds
+    :param max_workers: maximum number of collectors running at the same time (all of them if None)
+    :param timeout: seconds a collector is allowed to run before being abandoned (no limit if None)
+    :param stop: threading.Event that ends the loop once set
+    """
+    slots = threading.Semaphore(max(1, max_workers or len(jobs)))
+    lock = threading.Lock()
+    stop = stop or threading.Event()
+
+    next_run = {name: time.monotonic() for name in jobs}
+    running = {}
+    while not stop.is_set():
+        for name, thread in list(running.items()):
+            if thread.finished.is_set():
+                logger.info("Collector '%s' %s in %.1f seconds", name, 'failed' if thread.error is not None else 'finished',
+                            thread.finished_at - thread.started_at)
+                del running[name]
+            elif _abandon_if_late(thread, slots, lock, timeout):
+                del running[name]
+        now = time.monotonic()
+        for name, target in jobs.items():
+            if name not in running and now >= next_run[name]:
+                next_run[name] = now + intervals[name]
+                running[name] = _Job(name, target, slots, lock)
+                running[name].start()
+        stop.wait(poll_interval)
@@ -1,11 +1,29 @@
+import csv
+import queue
+import threading
 import requests
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urljoin
+from . import instrumentation
 from .setup import config, logger
 
+_session = None
+
+def _get_session():
+    """Pooled keep-alive session shared by all the threads"""
+    global _session
+    if _session is None:
+        _session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=len(config.get('SOLR_CORES', {})) or 1,
+                                                pool_maxsize=max(config.get('SOLR_BIBCODES_WORKERS', 4), config.get('SOLR_STATS_WORKERS', 6)))
+        _session.mount('http://', adapter)
+        _session.mount('https://', adapter)
+    return _session
+
 def _updates(solr_url):
     results = {}
     query = 'admin/mbeans?stats=true&cat=UPDATE&wt=json'
-    r = requests.get(urljoin(solr_url, query), timeout=30)
+    r = instrumentation.counted('solr', _get_session().get(urljoin(solr_url, query), timeout=30))
     r.raise_for_status()
     j = r.json()
     updateHandler_stats = j.get('solr-mbeans', [{}, {}])[1].get('updateHandler', {}).get('stats', {})
@@ -18,7 +36,7 @@ def _updates(solr_url):
 def _index(solr_url):
     results = {}
     query = 'replication?command=details&wt=json'
-    r = requests.get(urljoin(solr_url, query), timeout=30)
+    r = instrumentation.counted('solr', _get_session().get(urljoin(solr_url, query), timeout=30))
     r.raise_for_status()
     j = r.json()
     details = j.get('details', {})
@@ -42,7 +60,7 @@ def _index(solr_url):
 def _content(solr_url):
     results = {}
     query = 'select?q=*:*&rows=0&stats=true&stats.field=citation_count&stats.field=citation_count_norm'
-    r = requests.get(urljoin(solr_url, query), timeout=30)
+    r = instrumentation.counted('solr', _get_session().get(urljoin(solr_url, query), timeout=30))
     r.raise_for_status()
     j = r.json()
     results['num_found'] = j.get('response', {}).get('numFound')
@@ -55,46 +73,184 @@ def _content(solr_url):
         results['citation_count_norm'] = float("{:.2f}".format(results['citation_count_norm']))
     return results
 
+STATS_QUERIES = (
+    ('update', _updates),
+    ('index', _index),
+    ('content', _content),
+)
+
+def _timed_query(core, name, query, solr_url):
+    with instrumentation.timed('solr', name if core == 'default' else "{}_{}".format(core, name)):
+        return query(solr_url)
+
+def _stats(solr_urls):
+    """Query every stats endpoint of every core concurrently, returns {core: results}"""
+    results = {core: {} for core in solr_urls}
+    timed_query = instrumentation.propagate(_timed_query)
+    with ThreadPoolExecutor(max_workers=config.get('SOLR_STATS_WORKERS', 6)) as executor:
+        futures = [(core, name, executor.submit(timed_query, core, name, query, solr_url)) for core, solr_url in solr_urls.items() for name, query in STATS_QUERIES]
+        for core, name, future in futures:
+            try:
+                results[core].update(future.result())
+            except:
+                logger.exception("Failed retreiving %s stats from solr '%s'", name, core)
+    return results
+
 def stats():
     solr_url = config.get('SOLR_URL')
+    return _stats({'default': solr_url})['default']
 
-    results = {}
-    try:
-        results.update(_updates(solr_url))
-    except:
-        logger.exception("Failed retreiving update stats from solr")
-    try:
-        results.update(_index(solr_url))
-    except:
-        logger.exception("Failed retreiving index stats from solr")
-    try:
-        results.update(_content(solr_url))
-    except:
-        logger.exception("Failed retreiving content stats from solr")
+def cores_stats():
+    """Stats of every core/replica in SOLR_CORES, as {core: results}"""
+    return _stats(config.get('SOLR_CORES', {}))
 
-    return results
 
+def _shards(boundaries):
+    """Split the bibcode space in [lower, upper) ranges, the first and last ones being open"""
+    boundaries = sorted(boundaries)
+    return list(zip([None] + boundaries, boundaries + [None]))
 
-def bibcodes():
-    solr_url = config.get('SOLR_URL')
-    query = 'select?fl=bibcode&cursorMark={}&q=*%3A*&rows=20000&sort=bibcode%20asc%2Cid%20asc&wt=json'
-    bibcodes = []
+def _range(lower, upper, include_lower=True):
+    return 'bibcode:{}{} TO {}{}'.format('[' if include_lower else '{',
+                                         '"{}"'.format(lower) if lower is not None else '*',
+                                         '"{}"'.format(upper) if upper is not None else '*',
+                                         '}' if upper is not None else ']')
 
-    try:
-        current_cursormark = '*'
-        last_cursormark = None
-        while current_cursormark != last_cursormark:
-            url = urljoin(solr_url, query.format(current_cursormark))
-            r = requests.get(url)
+def _walk_json(solr_url, lower, upper, rows, timeout):
+    """Walk a bibcode range (the whole collection if unbounded) with cursorMark, yielding every page"""
+    params = {
+        'q': '*:*',
+        'fl': 'bibcode',
+        'rows': rows,
+        'sort': 'bibcode asc,id asc',
+        'omitHeader': 'true',
+        'wt': 'json',
+    }
+    if lower is not None or upper is not None:
+        # Same filter on every page, cached once per shard
+        params['fq'] = _range(lower, upper)
+    current_cursormark = '*'
+    last_cursormark = None
+    while current_cursormark != last_cursormark:
+        params['cursorMark'] = current_cursormark
+        with instrumentation.timed('solr', 'bibcodes') as fetched:
+            r = instrumentation.counted('solr', _get_session().get(urljoin(solr_url, 'select'), params=params, timeout=timeout))
             r.raise_for_status()
             last_cursormark = current_cursormark
             j = r.json()
             current_cursormark = j.get('nextCursorMark')
             docs = j.get('response', {}).get('docs', [])
-            bibcodes.extend(x['bibcode'] for x in docs)
+            fetched['rows'] += len(docs)
+        yield [x['bibcode'] for x in docs]
+
+def _walk_csv(solr_url, lower, upper, rows, timeout):
+    """
+    Walk a bibcode range (the whole collection if unbounded) with plain CSV responses (one
+    bibcode per line), yielding every page. Pages are requested on the last bibcode seen since
+    the CSV writer does not return a cursorMark, that filter changes on every page so it is not
+    cached. Documents sharing a bibcode are returned once per page boundary at most, which is
+    fine for set comparisons.
+    """
+    params = {
+        'q': '*:*',
+        'fl': 'bibcode',
+        'rows': rows,
+        'sort': 'bibcode asc',
+        'omitHeader': 'true',
+        'wt': 'csv',
+        'csv.header': 'false',
+    }
+    fq = _range(lower, upper)
+    while True:
+        params['fq'] = '{!cache=false}' + fq
+        with instrumentation.timed('solr', 'bibcodes') as fetched:
+            r = instrumentation.counted('solr', _get_session().get(urljoin(solr_url, 'select'), params=params, timeout=timeout))
+            r.raise_for_status()
+            page = [row[0] for row in csv.reader(r.text.splitlines()) if row]
+            fetched['rows'] += len(page)
+        yield page
+        if len(page) < rows:
+            break
+        fq = _range(page[-1], upper, include_lower=False)
+
+def _walk():
+    return _walk_csv if config.get('SOLR_BIBCODES_FORMAT', 'json') == 'csv' else _walk_json
+
+# End of a shard walk in its page queue
+_DONE = object()
+
+def _put(pages, stop, item):
+    """Put item in the pages queue unless stop is set first, returns whether it was put"""
+    while not stop.is_set():
+        try:
+            pages.put(item, timeout=0.5)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+def _walk_shard(pages, stop, walk, *args):
+    """Put every page of walk(*args) in the pages queue, then _DONE (or the exception raised)"""
+    if stop.is_set():
+        return
+    try:
+        for page in walk(*args):
+            if not _put(pages, stop, page):
+                return
+    except Exception as e:
+        _put(pages, stop, e)
+    else:
+        _put(pages, stop, _DONE)
+
+def _sharded_bibcodes(boundaries):
+    """
+    Export every shard concurrently, yielding them in order so that the stream stays sorted. Each
+    shard walk only keeps SOLR_BIBCODES_PREFETCH pages ahead of the consumer, the walks of the
+    shards that are not consumed yet wait for it instead of loading the whole shard.
+    """
+    solr_url = config.get('SOLR_URL')
+    rows = config.get('SOLR_BIBCODES_ROWS', 20000)
+    timeout = config.get('SOLR_BIBCODES_TIMEOUT', 120)
+    walk = _walk()
+    shards = _shards(boundaries)
+    shard_pages = [queue.Queue(maxsize=config.get('SOLR_BIBCODES_PREFETCH', 2)) for _ in shards]
+    stop = threading.Event()
+    executor = ThreadPoolExecutor(max_workers=config.get('SOLR_BIBCODES_WORKERS', 4))
+    try:
+        # Submitted in order, so the shard being consumed always has a worker
+        for pages, (lower, upper) in zip(shard_pages, shards):
+            executor.submit(instrumentation.propagate(_walk_shard), pages, stop, walk, solr_url, lower, upper, rows, timeout)
+        for pages in shard_pages:
+            while True:
+                page = pages.get()
+                if page is _DONE:
+                    break
+                if isinstance(page, Exception):
+                    raise page
+                yield from page
+    finally:
+        # Also when the consumer stops early: the walks give up and the pending ones return at once
+        stop.set()
+        executor.shutdown(wait=True)
+
+def sorted_bibcodes():
+    """
+    Stream bibcodes in ascending order walking the collection in a single walk, or in
+    SOLR_BIBCODES_SHARDS concurrently (exceptions are propagated)
+    """
+    boundaries = config.get('SOLR_BIBCODES_SHARDS', None)
+    if boundaries:
+        yield from _sharded_bibcodes(boundaries)
+        return
+    for page in _walk()(config.get('SOLR_URL'), None, None, config.get('SOLR_BIBCODES_ROWS', 20000), config.get('SOLR_BIBCODES_TIMEOUT', 120)):
+        yield from page
+
+
+def bibcodes():
+    try:
+        bibcodes = list(sorted_bibcodes())
     except:
         logger.exception("Failed retrieving bibcodes from solr")
         return []
     else:
         return bibcodes
-